@@ -1,14 +1,26 @@
-from flask import Blueprint, Flask, request, render_template, redirect, session, jsonify, flash
-from jinja2 import Environment, BaseLoader
+from flask import Blueprint, Flask, request, render_template, redirect, session, jsonify, flash, abort, send_file, \
+    stream_template, g, before_render_template, template_rendered
 from flask_wtf.csrf import CSRFProtect
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date, is_resource_modified, parse_date
 from werkzeug.utils import secure_filename
 from dotenv import dotenv_values
-from utilities import ArticleDb
+from asgiref.sync import sync_to_async
+from utilities import IMAGE_MIMETYPES, ArticleDb, AsyncArticleDb, BlockingReads, LRUCache, LikeBuffer, \
+    MemorySnapshots, Metrics, TemplateCache, Prerenderer, ResponseCompressor, UnsupportedImage, export_content, \
+    highlight, image_mimetype, image_store_from_url, import_content, migrate, migrate_article_images, \
+    page_cache_from_url, page_limit, schema_version, snapshot_store_from_url
 from datetime import datetime
+import asyncio
+import click
+import functools
+import hashlib
+import inspect
 import re
 import os
-import base64
-import random
+import io
+import time
+from urllib.parse import quote
 
 # os.system("npm run")
 config = dotenv_values('.env')
@@ -18,93 +30,555 @@ app = Flask(__name__)
 UPLOAD_FOLDER = 'static/uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# browser cache lifetimes in seconds. Article images never change once uploaded, thumbnails are revalidated with their etag
+IMAGE_MAX_AGE = 31536000
+THUMBNAIL_MAX_AGE = 60
+
 # initialize CSRF protection
 csrf = CSRFProtect(app)
 
 # checks if working in local development environment or production environment
 if 'PUBLIC' in os.environ:
     # if connection string is not in local environment variables then we are working in local environment
-    db = ArticleDb(config['LOCAL_DB'])
+    settings = config
+    db_conn_string = config['LOCAL_DB']
     app.secret_key = config['SECRET_KEY']
 else:
     # for production. Looks for connection string in environment variables
     print('Loading config.production.')
-    db = ArticleDb(os.environ['CONN_STRING'])
+    settings = os.environ
+    db_conn_string = os.environ['CONN_STRING']
+
+# read replicas, comma separated connection strings. Reads go to them round_robin or least_busy, a replica that fails
+# or lags more than DB_REPLICA_MAX_LAG seconds is left out for DB_REPLICA_EJECT_SECONDS
+db_replicas = [replica.strip() for replica in settings.get('DB_REPLICAS', '').split(',') if replica.strip()]
+
+# a session that wrote reads from the primary for this many seconds, so it sees its own writes
+DB_STICKY_SECONDS = float(settings.get('DB_STICKY_SECONDS', 5))
+PRIMARY_COOKIE = 'primary_until'
+
+# size the pool against the number of threads per worker. The defaults keep a single shared connection
+db = ArticleDb(db_conn_string,
+               min_size=int(settings.get('DB_POOL_MIN', 1)),
+               max_size=int(settings.get('DB_POOL_MAX', 1)),
+               timeout=float(settings.get('DB_POOL_TIMEOUT', 30)),
+               related_text_weight=float(settings.get('RELATED_TEXT_WEIGHT', 0)),
+               prepare_statements=settings.get('DB_PREPARE', '1') == '1',
+               replicas=db_replicas,
+               replica_selection=settings.get('DB_REPLICA_SELECTION', 'round_robin'),
+               replica_eject_seconds=float(settings.get('DB_REPLICA_EJECT_SECONDS', 30)),
+               replica_max_lag=float(settings['DB_REPLICA_MAX_LAG']) if settings.get('DB_REPLICA_MAX_LAG') else None,
+               sticky_seconds=DB_STICKY_SECONDS)
+
+# with LIKE_BUFFER=1 like clicks are coalesced in memory and written in bulk instead of one statement per click
+if settings.get('LIKE_BUFFER') == '1':
+    likes = LikeBuffer(db, max_pending=int(settings.get('LIKE_BUFFER_SIZE', 500)),
+                       flush_interval=float(settings.get('LIKE_BUFFER_INTERVAL', 1.0)))
+else:
+    likes = db
+
+# with ASYNC_DB=1 the public read path runs on psycopg 3's asyncio driver and its independent queries run concurrently.
+# Otherwise the async views await the blocking queries one after another
+if settings.get('ASYNC_DB') == '1':
+    reads = AsyncArticleDb(db_conn_string,
+                           min_size=int(settings.get('ASYNC_DB_POOL_MIN', 1)),
+                           max_size=int(settings.get('ASYNC_DB_POOL_MAX', 10)),
+                           timeout=float(settings.get('DB_POOL_TIMEOUT', 30)))
+    like_reads = reads if likes is db else BlockingReads(likes)
+else:
+    reads = BlockingReads(db)
+    like_reads = BlockingReads(likes)
+
+# database, template and request timings, served at /metrics and sent back in Server-Timing headers. Statements
+# slower than SLOW_QUERY_MS milliseconds are logged
+metrics = Metrics(slow_query_ms=float(settings['SLOW_QUERY_MS']) if settings.get('SLOW_QUERY_MS') else None)
+db.observers.append(metrics.query_observer)
+if isinstance(reads, AsyncArticleDb):
+    reads.observers.append(metrics.query_observer)
+metrics.add_gauges(lambda: {('db_pool_' + key, ()): value for key, value in db.pool_stats().items()
+                            if key in ('size', 'idle', 'in_use', 'max_size')})
+
+# compiled article bodies, keyed by article id and a hash of the stored source
+template_cache = TemplateCache(max_entries=int(settings.get('TEMPLATE_CACHE_ENTRIES', 256)),
+                               max_bytes=int(settings.get('TEMPLATE_CACHE_BYTES', 32 * 1024 * 1024)))
+
+# rendered published articles without the per-user like button. memory:// or redis://host:port/db
+page_cache = page_cache_from_url(settings.get('PAGE_CACHE_URL', 'memory://'),
+                                 ttl=int(settings.get('PAGE_CACHE_TTL', 300)),
+                                 max_entries=int(settings.get('PAGE_CACHE_ENTRIES', 512)))
+
+# uploaded images, keyed by the sha256 of their bytes. db:// keeps them in postgres, file:///path on disk
+image_store = image_store_from_url(settings.get('IMAGE_STORE_URL', 'db://'), db,
+                                   max_bytes=int(settings.get('IMAGE_MAX_BYTES', 20 * 1024 * 1024)))
+
+# result pages of hot searches, mostly the prefixes typed while searching as you type
+search_cache = LRUCache(max_entries=int(settings.get('SEARCH_CACHE_ENTRIES', 1024)),
+                        ttl=int(settings.get('SEARCH_CACHE_TTL', 30)))
+
+# with PRERENDER_URL set, published articles, topic pages and the front page are rendered ahead of time into a
+# snapshot store and served from it. memory:// keeps them in each worker, which renders them itself when it starts
+# and again once the content version moved past them. file:///path is shared by every worker on the host or a front
+# proxy and built with `flask prerender`. The like button of a snapshot is loaded separately
+snapshots = snapshot_store_from_url(settings['PRERENDER_URL']) if settings.get('PRERENDER_URL') else None
+
+# html and json responses are compressed with br, zstd or gzip, whichever the client accepts first. Public responses
+# with an etag are compressed once and their encoded bytes kept for the next requests
+compressor = ResponseCompressor(min_bytes=int(settings.get('COMPRESSION_MIN_BYTES', 1024)),
+                                cache=LRUCache(max_entries=int(settings.get('COMPRESSION_CACHE_ENTRIES', 512)),
+                                               ttl=int(settings.get('COMPRESSION_CACHE_TTL', 3600)))) \
+    if settings.get('COMPRESSION', '1') == '1' else None
+
+# search snippets are escaped before their matches are marked
+app.add_template_filter(highlight)
+
+# public pages are revalidated by browsers on every view. Shared caches (the CDN) may serve them for CDN_MAX_AGE
+# seconds, and keep serving a stale copy for CDN_STALE seconds while they revalidate it in the background
+CDN_MAX_AGE = int(settings.get('CDN_MAX_AGE', 60))
+CDN_STALE = int(settings.get('CDN_STALE', 300))
+
+# streamed listings are flushed to the client in blocks of about this many characters
+STREAM_BUFFER_SIZE = 16384
+
+# marks where the like button goes in a cached article body
+LIKE_BUTTON_SLOT = '<!-- like-button -->'
+
+# takes the like button's place in a pre-rendered article, the page fetches the button from this url
+LIKE_WIDGET_SLOT = '<div data-like-widget="/blog/like_widget/%d"></div>'
+
+# pages with snapshots, everything else is always rendered on request
+SNAPSHOT_ENDPOINTS = ('browse_articles', 'articles_all', 'articles_by_topic', 'read_article')
 
 user_id = 0 #todo: change this when implementing
 
+def article_cache_key(article_id, modified, version):
+    # an edit changes the key in every process, so no worker serves a body older than the article's etag
+    return 'article:%s:%s:%s' % (article_id, modified, version)
+
+def invalidate_article(article_id):
+    """Drops everything cached for an article after it was written to. Rendered bodies are keyed by the article's
+    modification time and go stale on their own"""
+    template_cache.invalidate(int(article_id))
+
+@app.after_request
+def compress_response(response):
+    # registered first so it runs after every other after_request hook, on the final body
+    if compressor is not None:
+        return compressor.process(request, response)
+    return response
+
+@app.before_request
+def start_timing():
+    # registered first so the wait for a pooled connection counts towards the request
+    g.request_started = time.perf_counter()
+    metrics.start_request()
+
+@app.after_request
+def finish_timing(response):
+    if 'request_started' in g:
+        total = time.perf_counter() - g.request_started
+        metrics.observe('request_seconds', {'endpoint': request.endpoint or 'none', 'method': request.method,
+                                            'status': response.status_code}, total)
+        response.headers['Server-Timing'] = metrics.server_timing(total)
+    return response
+
+@before_render_template.connect_via(app)
+def template_started(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def template_finished(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if starts:
+        seconds = time.perf_counter() - starts.pop()
+        # article bodies are compiled from strings and have no name
+        metrics.observe('template_render_seconds', {'template': template.name or 'article_body'}, seconds)
+        metrics.record('tpl', seconds)
+
+@app.before_request
+def serve_snapshot():
+    # answered before a connection is checked out. Pages with query arguments are never pre-rendered
+    if snapshots is None or request.method not in ('GET', 'HEAD') or request.query_string:
+        return None
+    if isinstance(snapshots, MemorySnapshots):
+        prerenderer.fill_once(snapshot_paths)
+    # the session wrote a moment ago and its pages may still be re-rendering, it reads them fresh like it reads the
+    # primary
+    if PRIMARY_COOKIE in request.cookies:
+        return None
+    path = request.path
+    snapshot = snapshots.get(path)
+    if snapshot is None:
+        return None
+
+    body, headers = snapshot
+    if isinstance(snapshots, MemorySnapshots) and headers.get('Content-Version') != db.get_content_version()[0]:
+        # published content changed, possibly through another worker that only refreshed its own store. The page is
+        # served dynamically until it is rendered again
+        snapshots.delete(path)
+        prerenderer.refresh(lambda: [path])
+        return None
+    response = app.response_class(body, content_type=headers.get('Content-Type'))
+    if 'X-Next-Cursor' in headers:
+        response.headers['X-Next-Cursor'] = headers['X-Next-Cursor']
+    return cacheable(response, headers['ETag'], parse_date(headers['Last-Modified'])).make_conditional(request)
+
+@app.before_request
+def checkout_connection():
+    # every request works on its own pooled connection
+    if request.endpoint != 'static':
+        db.checkout()
+        # the session wrote in an earlier request, its reads stay on the primary until replicas caught up
+        if db_replicas and PRIMARY_COOKIE in request.cookies:
+            try:
+                db.stick_to_primary(float(request.cookies[PRIMARY_COOKIE]) - time.time())
+            except ValueError:
+                pass
+
+@app.after_request
+def remember_write(response):
+    if (db_replicas or snapshots is not None) and db.wrote():
+        response.set_cookie(PRIMARY_COOKIE, '%.3f' % (time.time() + DB_STICKY_SECONDS),
+                            max_age=int(DB_STICKY_SECONDS) + 1, httponly=True, samesite='Lax')
+    return response
+
+@app.teardown_request
+def release_connection(exc):
+    db.release()
+    metrics.end_request()
+
+def cacheable(response, etag, last_modified):
+    """Marks a public page as revalidated by browsers on every view and cached by the CDN for CDN_MAX_AGE"""
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'public, max-age=0, s-maxage=%d, stale-while-revalidate=%d' % (
+        CDN_MAX_AGE, CDN_STALE)
+    return response
+
+def conditional(validators):
+    """Makes a public view answer conditional requests. validators(**view_args) returns (etag, last_modified) of the
+    content the view would render, or None when the response must not be cached. A client or CDN holding a current
+    copy gets a 304 before the view runs any of its queries"""
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            # blocking validators are run on the request's thread, which holds its pinned connection
+            check = validators if inspect.iscoroutinefunction(validators) else sync_to_async(validators)
+
+            @functools.wraps(view)
+            async def wrapper(**kwargs):
+                current = await check(**kwargs)
+                if current is None:
+                    return await view(**kwargs)
+
+                etag, last_modified = current
+                if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                    return cacheable(app.response_class(status=304), etag, last_modified)
+                return cacheable(app.make_response(await view(**kwargs)), etag, last_modified)
+            return wrapper
+
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            current = validators(**kwargs)
+            if current is None:
+                return view(**kwargs)
+
+            etag, last_modified = current
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                return cacheable(app.response_class(status=304), etag, last_modified)
+            return cacheable(app.make_response(view(**kwargs)), etag, last_modified)
+        return wrapper
+    return decorator
+
+def listing_validators(**kwargs):
+    # listings only change when published content does, which always bumps the content version
+    version, updated_at = db.get_content_version()
+    # kept for the view, search pages are cached per version
+    g.content_version = version
+    return 'v%s' % version, updated_at
+
+async def article_validators(id):
+    row, like_count = await asyncio.gather(reads.get_article_version(id), like_reads.get_like_count(id, user_id))
+    # the like button is part of the page. Kept for the view so the count is not read twice
+    g.like_count = like_count
+    if row is None or row[0] != 'publish':
+        return None
+    status, modified, version, updated_at = row
+    g.article_cache_key = article_cache_key(id, modified, version)
+
+    key = '%s|%s|%s|%s' % (id, modified, version, g.like_count)
+    # every change to a published article bumps the version, so its time is the article's last modification too
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=12).hexdigest(), updated_at
+
+def published_page(topic=None, search=None):
+    """Returns (articles, next_cursor) for the page of published articles selected by the ?cursor=&limit= args"""
+    try:
+        articles, next_cursor = db.get_article_summary_page('publish', page_limit(request.args.get('limit')),
+                                                            request.args.get('cursor') or None, topic, search)
+    except ValueError:
+        abort(400)
+
+    return [list(article) for article in articles], next_cursor
+
+def search_page(search):
+    """Returns (articles, next_cursor) for a page of ranked search results. The cursor of a search is the offset of
+    the next page, pages are cached for a short time"""
+    try:
+        offset = int(request.args.get('cursor') or 0)
+    except ValueError:
+        abort(400)
+    if offset < 0:
+        abort(400)
+    limit = page_limit(request.args.get('limit'))
+
+    # publishing bumps the content version, so every worker stops using pages cached before it
+    version = g.content_version if 'content_version' in g else db.get_content_version()[0]
+    key = '%s:%s:%s:%s' % (version, offset, limit, search)
+    page = search_cache.get(key)
+    if page is None:
+        page = db.search_article_page('publish', search, limit, offset)
+        search_cache.set(key, page)
+
+    articles, next_offset = page
+    return [list(article) for article in articles], str(next_offset) if next_offset is not None else None
+
+def buffered(chunks, size=STREAM_BUFFER_SIZE):
+    """Joins small template chunks so a streamed response is flushed in blocks of about size characters"""
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
+
+def render_cards(topic=None, search=None):
+    """Renders the published article cards selected by ?cursor=&limit= in a single template pass. The cursor of the
+    following page is sent in the X-Next-Cursor header. Searches are ranked by relevance, everything else is newest
+    first. With ?stream=1 every card after the cursor is streamed newest first as rows come off a server-side cursor
+    instead"""
+    if request.args.get('stream') == '1':
+        try:
+            articles = db.iter_article_summaries('publish', request.args.get('cursor') or None, topic, search)
+        except ValueError:
+            abort(400)
+        # stream_template keeps the request context, and with it the pinned connection, alive until the last card
+        return app.response_class(buffered(stream_template('components/article_cards.html', articles=articles)),
+                                  mimetype='text/html')
+
+    if search is not None:
+        articles, next_cursor = search_page(search)
+    else:
+        articles, next_cursor = published_page(topic)
+    response = app.make_response(render_template('components/article_cards.html', articles=articles))
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
 @app.route('/')
-def browse_articles():  # put application's code here
-    topics = db.get_topics()
-    articles = [list(draft) for draft in db.get_articles('publish')]
-    images = []
-    for idx, draft in enumerate(articles):
-        images.append(bytes(draft[9]).decode('utf-8'))
-    return render_template('browse_articles.html', articles=articles, thumbnails=images, topics=topics)
+@conditional(listing_validators)
+async def browse_articles():  # put application's code here
+    try:
+        topics, (articles, next_cursor) = await asyncio.gather(
+            reads.get_topics(),
+            reads.get_article_summary_page('publish', page_limit(request.args.get('limit')),
+                                           request.args.get('cursor') or None))
+    except ValueError:
+        abort(400)
+    articles = [list(article) for article in articles]
+    return render_template('browse_articles.html', articles=articles, topics=topics, next_cursor=next_cursor)
 
 @app.get('/blog/browse/topic/<topic>')
+@conditional(listing_validators)
 def articles_by_topic(topic):
-    articles = [list(article) for article in db.query_articles_by_topic('publish', topic)]
-
-    rendered_articles = ''
-    for article in articles:
-        thumbnail = bytes(article[9]).decode('utf-8')
-        rendered = render_template('components/article_cards.html', article=article, thumbnail=thumbnail)
-        rendered_articles += ''.join(rendered)
-
-    return rendered_articles
+    return render_cards(topic=topic)
 
 @app.get('/blog/browse/all')
+@conditional(listing_validators)
 def articles_all():
-    articles = [list(article) for article in db.get_articles('publish')]
-
-    rendered_articles = ''
-    for article in articles:
-        thumbnail = bytes(article[9]).decode('utf-8')
-        rendered = render_template('components/article_cards.html', article=article, thumbnail=thumbnail)
-        rendered_articles += ''.join(rendered)
-
-    return rendered_articles
+    return render_cards()
 
 @app.get('/blog/browse/search/', defaults={'search': None})
 @app.get('/blog/browse/search/<search>')
+@conditional(listing_validators)
 def articles_search(search):
-    if not search:
-        articles = [list(article) for article in db.get_articles('publish')]
+    return render_cards(search=search or None)
+
+def image_response(data, etag, last_modified, max_age, mimetype=None):
+    """Builds a cacheable response for raw image bytes. data is None when the client's copy matched etag"""
+    if data is None:
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
     else:
-        articles = [list(article) for article in db.search_articles('publish', search)]
-
-    rendered_articles = ''
-    for article in articles:
-        thumbnail = bytes(article[9]).decode('utf-8')
-        rendered = render_template('components/article_cards.html', article=article, thumbnail=thumbnail)
-        rendered_articles += ''.join(rendered)
-
-    return rendered_articles
-
-@app.route('/blog/read/<id>')
-def read_article(id):
-    article = db.get_article(id)
-    images = db.get_article_images(id)
-    thumbnail = bytes(article[9]).decode('utf-8')
+        data = bytes(data)
+        response = send_file(io.BytesIO(data), mimetype=mimetype or image_mimetype(data), etag=etag,
+                             last_modified=last_modified, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.no_cache = None
+    response.cache_control.max_age = max_age
+    # served from the blog's own origin, anything that is not a plain image must never be rendered as a document
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if data is not None and response.mimetype not in IMAGE_MIMETYPES:
+        response.headers['Content-Security-Policy'] = 'sandbox'
+        response.headers['Content-Disposition'] = 'attachment'
+    return response
+
+@app.get('/blog/image/<int:id>')
+def article_image(id):
+    image = db.get_image(id, request.if_none_match.as_set(include_weak=True))
+    if image is None:
+        abort(404)
+
+    file_name, etag, last_modified, data = image
+    response = image_response(data, etag, last_modified, IMAGE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+@app.get('/blog/images/<digest>/<variant>')
+def stored_image(digest, variant):
+    if not re.fullmatch('[0-9a-f]{64}', digest) or variant not in image_store.variants and variant != 'original':
+        abort(404)
+
+    # a digest names its bytes forever, a client holding any copy of this url is current
+    etag = '%s-%s' % (digest, variant)
+    if etag in request.if_none_match:
+        response = image_response(None, etag, None, IMAGE_MAX_AGE)
+    else:
+        image = image_store.get(digest, variant)
+        if image is None:
+            abort(404)
+        mimetype, last_modified, data = image
+        response = image_response(data, etag, last_modified, IMAGE_MAX_AGE, mimetype)
+    response.cache_control.immutable = True
+    return response
+
+@app.get('/blog/thumbnail/<int:article_id>')
+def article_thumbnail(article_id):
+    thumbnail = db.get_thumbnail(article_id, request.if_none_match.as_set(include_weak=True))
+    if thumbnail is None:
+        abort(404)
+
+    etag, last_modified, data = thumbnail
+    return image_response(data, etag, last_modified, THUMBNAIL_MAX_AGE)
+
+async def render_article_body(id):
+    """Renders everything on the article page except the like button. Returns (body, cacheable)"""
+    # the article and a few related articles sampled from its precomputed neighbours, queried concurrently
+    article, related_articles = await asyncio.gather(reads.get_article(id), reads.get_related_article_summaries(id))
+    if article is None:
+        abort(404)
+    related_articles = [list(related) for related in related_articles]
+
+    # images are referenced by url and load lazily, no image bytes are read to render an article
+    article_con = template_cache.get(article[0], article[10])
+    content = render_template(article_con)
+
+    body = render_template('components/article_body.html', article=article, content=content,
+                           related_articles=related_articles, like_button=LIKE_BUTTON_SLOT)
+
+    # drafts are only seen by editors and change constantly, only published articles are cached
+    return body, article[1] == 'publish'
+
+@app.route('/blog/read/<int:id>')
+@conditional(article_validators)
+async def read_article(id):
+    # only published articles have validators, and with them a cache key
+    key = g.get('article_cache_key')
+    body = page_cache.get(key) if key is not None else None
+    if body is None:
+        body, published = await render_article_body(id)
+        if published and key is not None:
+            page_cache.set(key, body)
 
     # generate likes count
-    likes_btn = db.get_like_count(id, user_id)
-
-    # generate a list of related articles by randomly selecting a topic from the topic list
-    topic_int = random.randint(0, len(article[8])-1)
-    related_articles = [list(draft) for draft in db.query_related_articles('publish', article[8][topic_int], id)]
-    related_images = []
-
-    for idx, draft in enumerate(related_articles):
-        related_images.append(bytes(draft[9]).decode('utf-8'))
-
-    article_con = Environment(loader=BaseLoader).from_string(article[10])
-    content = render_template(article_con, image=images)
-
-    return render_template('article_view.html', article=article, thumbnail=thumbnail, image=images,
-                           content=content, related_articles=related_articles, related_thumbnails=related_images,
-                           liked=likes_btn)
+    likes_btn = g.like_count if 'like_count' in g else await like_reads.get_like_count(id, user_id)
+    like_button = render_template('components/article_like.html', liked=likes_btn)
+
+    return render_template('article_view.html', article_id=id, body=body.replace(LIKE_BUTTON_SLOT, like_button, 1))
+
+@app.get('/blog/like_widget/<int:id>')
+async def like_widget(id):
+    # the only per-user part of a pre-rendered article
+    response = app.make_response(render_template('components/article_like.html',
+                                                 liked=await like_reads.get_like_count(id, user_id)))
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+def render_snapshot(path):
+    """Renders the page at path for the snapshot store. Returns (html, headers), or None for a page that has no
+    snapshot, such as an article that is not published"""
+    with app.test_request_context(quote(path)):
+        db.checkout()
+        try:
+            # just written content may not have reached the replicas yet
+            db.stick_to_primary(DB_STICKY_SECONDS)
+            # read before rendering, a snapshot is never marked newer than what it shows
+            version = db.get_content_version()[0]
+            endpoint, view_args = request.url_rule.endpoint, request.view_args
+            if endpoint not in SNAPSHOT_ENDPOINTS:
+                return None
+
+            if endpoint == 'read_article':
+                body, published = app.ensure_sync(render_article_body)(**view_args)
+                if not published:
+                    return None
+                html = render_template('article_view.html', article_id=view_args['id'],
+                                       body=body.replace(LIKE_BUTTON_SLOT, LIKE_WIDGET_SLOT % view_args['id'], 1))
+                headers = {'Content-Type': 'text/html; charset=utf-8'}
+            else:
+                response = app.make_response(app.ensure_sync(app.view_functions[endpoint])(**view_args))
+                if response.status_code != 200:
+                    return None
+                html = response.get_data(as_text=True)
+                headers = {name: response.headers[name] for name in ('Content-Type', 'X-Next-Cursor')
+                           if name in response.headers}
+        except HTTPException:
+            return None
+        finally:
+            db.release()
+
+    headers['Last-Modified'] = http_date(time.time())
+    headers['Content-Version'] = version
+    return html, headers
+
+def topic_path(topic):
+    # snapshots are keyed by the decoded path, like request.path
+    return '/blog/browse/topic/' + topic
+
+def snapshot_paths():
+    """Every page with a snapshot: the front page, the listing of all articles, every topic with published articles
+    and every published article"""
+    paths = ['/', '/blog/browse/all']
+    paths += [topic_path(topic) for topic, count in db.get_topics() if count]
+    paths += ['/blog/read/%d' % row[0] for row in db.iter_article_summaries('publish')]
+    return paths
+
+prerenderer = Prerenderer(snapshots, render_snapshot, workers=int(settings.get('PRERENDER_WORKERS', 4))) \
+    if snapshots is not None else None
+
+def refresh_snapshots(article_id, neighbours=()):
+    """Re-renders, in the background, every snapshot an article that was written to shows up on: its own page, the
+    listings and the pages that list it as a related article. neighbours are those pages found before the write"""
+    if prerenderer is None:
+        return
+
+    def affected_paths():
+        db.checkout()
+        try:
+            db.stick_to_primary(DB_STICKY_SECONDS)
+            # topics the article left keep a snapshot until they are rendered once more
+            topics = [topic_path(topic) for topic, count in db.get_topics() if count]
+            topics += [path for path in snapshots.paths() if path.startswith('/blog/browse/topic/')]
+            related = set(neighbours) | set(db.get_articles_related_to(article_id))
+        finally:
+            db.release()
+        return (['/blog/read/%s' % article_id, '/', '/blog/browse/all'] + topics +
+                ['/blog/read/%d' % related_id for related_id in sorted(related)])
+
+    prerenderer.refresh(affected_paths)
 
 
 @app.get('/blog/like_article')
@@ -113,10 +587,15 @@ def like_article():
     user_id = request.args.get('user_id')
     user_liked = request.args.get('user_liked')
 
-    if user_liked == 'False': # meaning the user did not like the article prior to clicking the button
-        results = db.add_like(article_id, user_id)
-    else:
-        results = db.remove_like(article_id, user_id)
+    try:
+        if user_liked == 'False': # meaning the user did not like the article prior to clicking the button
+            results = likes.add_like(int(article_id), int(user_id))
+        else:
+            results = likes.remove_like(int(article_id), int(user_id))
+    except (TypeError, ValueError):
+        abort(400)
+    if results is None:
+        abort(404)
 
     btn_render = render_template("components/like_button.html", liked=results)
 
@@ -129,21 +608,31 @@ def like_article():
 ###############################################
 @app.route('/blog/drafts')
 def posts_drafts():
-    drafts = [list(draft) for draft in db.get_articles('draft')]
-    images = []
-    for idx, draft in enumerate(drafts):
-        images.append(bytes(draft[9]).decode('utf-8'))
-    print(drafts)
-    return render_template('articles_drafts.html', drafts=drafts, images=images)
+    drafts = [list(draft) for draft in db.get_article_summaries('draft')]
+    return render_template('articles_drafts.html', drafts=drafts)
 
 @app.route('/blog/published')
 def posts_published():
-    published = [list(draft) for draft in db.get_articles('publish')]
-    images = []
-    for idx, draft in enumerate(published):
-        images.append(bytes(draft[9]).decode('utf-8'))
+    published = [list(draft) for draft in db.get_article_summaries('publish')]
 
-    return render_template('articles_published.html', published=published, images=images)
+    return render_template('articles_published.html', published=published)
+
+@app.get('/blog/pool_stats')
+def pool_stats():
+    return jsonify(db.pool_stats())
+
+@app.get('/metrics')
+def prometheus_metrics():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.get('/blog/query_stats')
+def query_stats():
+    return jsonify(db.queries.stats())
+
+@app.get('/blog/cache_stats')
+def cache_stats():
+    return jsonify(templates=template_cache.stats(), pages=page_cache.stats(), searches=search_cache.stats(),
+                   compressed=compressor.cache.stats() if compressor is not None else None)
 
 @app.route('/blog/new_article')
 def new_article():
@@ -166,51 +655,63 @@ def edit_article(id):
 
     if article[8] == None:
         article[8] = []
-    article_con = Environment(loader=BaseLoader).from_string(article[10])
+    article_con = template_cache.get(article[0], article[10])
     content = render_template(article_con, image=images)
-    thumbnail = bytes(article[9]).decode('utf-8')
 
-    return render_template('edit_article.html', article=article, thumbnail=thumbnail, topics=topics, image=images, content=content)
+    return render_template('edit_article.html', article=article, topics=topics, image=images, content=content)
 
 @app.route('/blog/preview/<id>')
 def preview_article(id):
     article = db.get_article(id)
-    images = db.get_article_images(id)
-    thumbnail = bytes(article[9]).decode('utf-8')
 
-    article_con = Environment(loader=BaseLoader).from_string(article[10])
-    content = render_template(article_con, image=images)
+    article_con = template_cache.get(article[0], article[10])
+    content = render_template(article_con)
 
-    return render_template('preview.html', article=article, thumbnail=thumbnail, image=images, content=content)
+    return render_template('preview.html', article=article, content=content)
 
 
 @app.post('/uploadimage')
 def upload_image():
     image_load = request.files.get('image')
+    try:
+        article_id = int(request.form.get('articleId'))
+    except (TypeError, ValueError):
+        abort(400)
+    if image_load is None:
+        abort(400)
 
     filename = secure_filename(image_load.filename)
 
-    image = base64.b64encode(image_load.read())
-
-    with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), "wb") as fh:
-        fh.write(base64.decodebytes(image))
+    # read in chunks into the content addressed store, the same file uploaded twice is stored once
+    try:
+        digest = image_store.put(image_load.stream)
+    except UnsupportedImage:
+        abort(415)
+    except ValueError:
+        abort(413)
 
-    article_id = request.form.get('articleId')
     unique_identifier = filename + str(article_id)
-    db.add_article_image(article_id, unique_identifier, filename, image)
+    db.add_article_image(article_id, unique_identifier, filename, digest=digest)
+    invalidate_article(article_id)
 
-    return jsonify({'location': "/static/uploads/"+filename})
+    return jsonify({'location': image_store.url(digest, 'inline')})
 
 
 @app.post('/blog/set_published/<id>')
 def set_published(id):
     db.set_article_status(id, 'publish')
+    invalidate_article(id)
+    refresh_snapshots(id)
 
     return jsonify(results="Success")
 
 @app.post('/blog/delete_article/<id>')
 def delete_article(id):
+    # its related rows go with it, the pages showing it are found first
+    neighbours = db.get_articles_related_to(id)
     db.delete_article(id)
+    invalidate_article(id)
+    refresh_snapshots(id, neighbours)
 
     return jsonify(results="Success")
 
@@ -231,25 +732,20 @@ def publish_article():
     # Preprocessing data
     #######################
     if thumbnail != None:
-        image = base64.b64encode(thumbnail.read())
-
-        # image = thumbnail.read()
-        # print(type(image))
-
-        # with open(os.path.join(UPLOAD_FOLDER, "article_thumbnail.jpg"), "wb") as fh:
-        #     fh.write(base64.decodebytes(image))
+        # thumbnails are only ever shown on cards, store them at that size
+        resized = image_store.resize(thumbnail.stream, image_store.variants.get('card', 480))
+        if resized is not None:
+            image = resized[0]
+        else:
+            thumbnail.stream.seek(0)
+            image = thumbnail.read()
+            if image_mimetype(image, default=None) is None:
+                abort(415)
     else:
         image = None
 
-    # replace image filepath with jinja tag
-    all_images = re.findall("src=\"(.*?)\"", content)
-    oldDir = '/static/uploads/'
-
-    for img in all_images:
-        if oldDir in img:
-            image_name = img.replace(oldDir, "")
-            jinja_tag = "data:image/jpeg;base64,{{ image['" + image_name + "'] }}"
-            content = re.sub(img, jinja_tag, content)
+    # point images at the image store with srcset and size hints so they load lazily
+    content = image_store.article_body(content, db.get_article_image_digests(article_id))
 
     ###########################
     # Add data to databases
@@ -265,8 +761,79 @@ def publish_article():
     else:
         db.add_article(article_id, status, date_created, time_created, title, description, topics, image, content,
                        text_content)
+    invalidate_article(article_id)
+    refresh_snapshots(article_id)
 
     return jsonify(results=article_id)
 
+@app.cli.command('migrate')
+@click.option('--target', type=int, help='Stop after this schema version.')
+def migrate_schema(target):
+    """Applies pending schema migrations. Run once per deploy, before the new workers take traffic"""
+    applied = migrate(db, target)
+    print(f'Applied {len(applied)} migrations, schema is at version {schema_version(db)}.')
+
+def print_progress(table, rows):
+    print(f'{table}: {rows} rows', flush=True)
+
+@app.cli.command('export-content')
+@click.argument('directory')
+@click.option('--batch-size', default=5000, help='Rows per COPY statement.')
+def export_content_command(directory, batch_size):
+    """Exports articles, topics, images and likes to one ndjson file per table. An interrupted export resumes from its
+    checkpoint when run again"""
+    counts = export_content(db, directory, batch_size, progress=print_progress)
+    print('Exported ' + ', '.join(f'{rows} {table}' for table, rows in counts.items()) + '.')
+
+@app.cli.command('import-content')
+@click.argument('directory')
+@click.option('--batch-size', default=5000, help='Rows per transaction.')
+@click.option('--checkpoint', help='Checkpoint file, defaults to import-checkpoint.json in the directory.')
+def import_content_command(directory, batch_size, checkpoint):
+    """Imports the files written by export-content, skipping rows that already exist. An interrupted import resumes
+    from its checkpoint when run again"""
+    counts = import_content(db, directory, batch_size, checkpoint_path=checkpoint, progress=print_progress)
+    template_cache.clear()
+    page_cache.clear()
+    print('Imported ' + ', '.join(f'{rows} {table}' for table, rows in counts.items()) + '.')
+
+@app.cli.command('prerender')
+def prerender():
+    """Renders every published article, topic page and the front page into the snapshot store"""
+    if prerenderer is None:
+        raise click.UsageError('PRERENDER_URL is not set.')
+    if isinstance(snapshots, MemorySnapshots):
+        raise click.UsageError('PRERENDER_URL is memory://, each worker renders its own snapshots when it starts. '
+                               'Use file:///path for snapshots built ahead of time.')
+    rendered = prerenderer.build(snapshot_paths())
+    print(f'Pre-rendered {rendered} pages.')
+
+@app.cli.command('rebuild-topics')
+def rebuild_topics():
+    """Recomputes the denormalized article topics and the per-topic published counts"""
+    db.rebuild_topic_store()
+    print('Rebuilt topic store.')
+
+@app.cli.command('rebuild-related')
+def rebuild_related():
+    """Recomputes the precomputed related articles of every article"""
+    db.rebuild_related_articles()
+    page_cache.clear()
+    print('Rebuilt related articles.')
+
+@app.cli.command('migrate-images')
+def migrate_images():
+    """Moves article images into the image store and rewrites article bodies to load them lazily by url"""
+    imported, rewritten = migrate_article_images(db, image_store)
+    template_cache.clear()
+    page_cache.clear()
+    print(f'Imported {imported} images and rewrote {rewritten} articles.')
+
+@app.cli.command('convert-images')
+def convert_images():
+    """Decodes thumbnails and article images that were stored as base64 text into raw bytes"""
+    converted = db.convert_base64_images()
+    print(f'Converted {converted} images.')
+
 if __name__ == '__main__':
     app.run()
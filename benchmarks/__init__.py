@@ -0,0 +1,8 @@
+"""Reproducible benchmarks for the blog.
+
+    python -m benchmarks seed --db <conn string> --articles 2000
+    python -m benchmarks load --url http://127.0.0.1:5000 --concurrency 16 --duration 30
+    python -m benchmarks db --db <conn string> --baseline baseline.json
+
+See benchmarks/readme.md for the local Postgres setup.
+"""
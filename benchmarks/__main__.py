@@ -0,0 +1,100 @@
+import argparse
+import os
+import sys
+
+from . import corpus, db_methods, load
+from .stats import print_table, regressions, save
+
+LOAD_COLUMNS = ('count', 'errors', 'per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'mean_bytes')
+DB_COLUMNS = ('count', 'p50_ms', 'p95_ms', 'p99_ms', 'mean_ms')
+
+
+def connect(args):
+    # imported here so the load generator runs on machines without psycopg2
+    from utilities import ArticleDb, migrate
+    db = ArticleDb(args.db, prepare_statements=not args.no_prepare)
+    migrate(db)
+    return db
+
+
+def report(results, columns, args):
+    print_table(results, columns)
+    if args.output:
+        save(results, args.output)
+
+    if args.baseline:
+        slower = regressions(results, args.baseline, threshold=args.threshold)
+        for name, before, after in slower:
+            print('REGRESSION %s: p95 %.3f ms -> %.3f ms' % (name, before, after))
+        if slower:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Blog benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def database_options(command):
+        command.add_argument('--db', default=os.environ.get('BENCH_DB'),
+                             help='connection string of the benchmark database, defaults to $BENCH_DB')
+        command.add_argument('--no-prepare', action='store_true', help='run without server-side prepared statements')
+
+    def result_options(command):
+        command.add_argument('--output', help='write the results to this json file')
+        command.add_argument('--baseline', help='compare against the results json of an earlier run')
+        command.add_argument('--threshold', type=float, default=0.2,
+                             help='fail when a p95 got slower than the baseline by more than this fraction')
+
+    seed = commands.add_parser('seed', help='add a synthetic corpus to the benchmark database')
+    database_options(seed)
+    seed.add_argument('--articles', type=int, default=1000)
+    seed.add_argument('--likes', type=int, default=20, help='mean likes per published article')
+    seed.add_argument('--users', type=int, default=5000)
+    seed.add_argument('--seed', type=int, default=1)
+
+    run_load = commands.add_parser('load', help='drive the blog routes of a running server')
+    run_load.add_argument('--url', default='http://127.0.0.1:5000')
+    run_load.add_argument('--concurrency', type=int, default=8)
+    run_load.add_argument('--duration', type=float, default=30.0, help='seconds to run for')
+    run_load.add_argument('--requests', type=int, help='stop after this many requests instead of after --duration')
+    run_load.add_argument('--route', action='append', choices=sorted(load.DEFAULT_MIX),
+                          help='only request this route, may be given several times')
+    run_load.add_argument('--seed', type=int, default=1)
+    result_options(run_load)
+
+    run_db = commands.add_parser('db', help='time each ArticleDb method against the benchmark database')
+    database_options(run_db)
+    run_db.add_argument('--iterations', type=int, default=200)
+    run_db.add_argument('--warmup', type=int, default=20)
+    run_db.add_argument('--case', action='append', help='only run this case, may be given several times')
+    run_db.add_argument('--seed', type=int, default=1)
+    result_options(run_db)
+
+    for command in (seed, run_load, run_db):
+        command.add_argument('--manifest', default=corpus.MANIFEST_PATH,
+                             help='describes the seeded corpus, written by seed and read by load and db')
+
+    args = parser.parse_args()
+    if args.command in ('seed', 'db') and not args.db:
+        parser.error('--db or BENCH_DB is required')
+
+    if args.command == 'seed':
+        manifest = corpus.seed(connect(args), args.articles, args.likes, args.users, args.seed)
+        corpus.save_manifest(manifest, args.manifest)
+        print('Seeded %d published and %d draft articles.' % (len(manifest['published_ids']),
+                                                               len(manifest['draft_ids'])))
+
+    elif args.command == 'load':
+        mix = {route: load.DEFAULT_MIX[route] for route in args.route} if args.route else None
+        results = load.run(args.url, corpus.load_manifest(args.manifest), args.concurrency, args.duration,
+                           args.requests, mix, args.seed)
+        report(results, LOAD_COLUMNS, args)
+
+    else:
+        results = db_methods.run(connect(args), corpus.load_manifest(args.manifest), args.iterations, args.warmup,
+                                 args.case, args.seed)
+        report(results, DB_COLUMNS, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import json
+import random
+import struct
+import zlib
+from datetime import date, time, timedelta
+
+from psycopg2.extras import execute_values
+
+# seeded articles and the manifest the load generator and micro-benchmarks draw their requests from
+MANIFEST_PATH = 'benchmarks/manifest.json'
+
+TOPICS = ['Python', 'Postgres', 'Flask', 'Javascript', 'Css', 'Performance', 'Caching', 'Testing', 'Deployment',
+          'Security', 'Design', 'Career', 'Linux', 'Networking', 'Databases', 'Async', 'Rust', 'Go', 'Cloud', 'Data']
+
+WORDS = ('index query cache latency request response worker thread connection pool server client browser render '
+         'template stream buffer page cursor search rank vector topic article draft publish image thumbnail upload '
+         'variant compress encode decode schema migration replica primary lock transaction commit rollback batch '
+         'queue timeout retry profile benchmark throughput memory disk network socket header cookie session token '
+         'deploy container build release config setting logger metric histogram percentile sample window budget '
+         'python flask postgres jinja webp gzip brotli http json html css javascript linux docker kernel scheduler '
+         'fast slow simple careful robust small large early late often rarely always never quickly slowly').split()
+
+# share of articles left as drafts, like a real editor's backlog
+DRAFT_SHARE = 0.1
+
+
+def sentence(rng, words=None):
+    words = words or rng.randint(8, 20)
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+def article_body(rng):
+    """Returns (html, plain text) of an article of a few sections with paragraphs, lists and code"""
+    html = []
+    text = []
+    for _ in range(rng.randint(3, 8)):
+        heading = sentence(rng, rng.randint(3, 6))[:-1]
+        html.append('<h2>%s</h2>' % heading)
+        text.append(heading)
+
+        for _ in range(rng.randint(2, 5)):
+            paragraph = ' '.join(sentence(rng) for _ in range(rng.randint(3, 7)))
+            html.append('<p>%s</p>' % paragraph)
+            text.append(paragraph)
+
+        if rng.random() < 0.4:
+            items = [sentence(rng, rng.randint(4, 8)) for _ in range(rng.randint(3, 6))]
+            html.append('<ul>%s</ul>' % ''.join('<li>%s</li>' % item for item in items))
+            text.extend(items)
+
+        if rng.random() < 0.3:
+            code = '\n'.join('%s = %s(%s)' % (rng.choice(WORDS), rng.choice(WORDS), rng.choice(WORDS))
+                             for _ in range(rng.randint(3, 12)))
+            html.append('<pre><code>%s</code></pre>' % code)
+            text.append(code)
+
+    return '\n'.join(html), '\n'.join(text)
+
+
+def thumbnail(rng, width=480, height=270):
+    """A card sized gradient PNG built with the standard library, so seeding does not need Pillow"""
+    top = [rng.randrange(256) for _ in range(3)]
+    bottom = [rng.randrange(256) for _ in range(3)]
+    rows = []
+    for y in range(height):
+        pixel = bytes(int(a + (b - a) * y / height) for a, b in zip(top, bottom))
+        # filter byte, then the row's pixels. A little noise keeps it from compressing far better than a photo
+        rows.append(b'\x00' + b''.join(bytes((c + rng.randrange(3)) % 256 for c in pixel) for _ in range(width)))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) +
+            chunk(b'IEND', b''))
+
+
+def seed(db, articles=1000, likes_per_article=20, users=5000, seed_value=1, batch_size=200):
+    """Adds a synthetic corpus to db after its existing articles and returns the manifest describing it. The same
+    seed_value always produces the same corpus"""
+    rng = random.Random(seed_value)
+    first_id = db.new_article_id()
+    start = date(2020, 1, 1)
+
+    published = []
+    drafts = []
+    thumbnails = [thumbnail(rng) for _ in range(16)]
+    for offset in range(0, articles, batch_size):
+        rows = []
+        assignments = []
+        for article_id in range(first_id + offset, first_id + min(offset + batch_size, articles)):
+            status = 'draft' if rng.random() < DRAFT_SHARE else 'publish'
+            (published if status == 'publish' else drafts).append(article_id)
+
+            # a few topics are much more popular than the rest
+            topics = list(dict.fromkeys(rng.choices(TOPICS, weights=range(len(TOPICS), 0, -1),
+                                                    k=rng.randint(1, 4))))
+            content, content_text = article_body(rng)
+            created = start + timedelta(days=rng.randrange(5 * 365))
+            rows.append((article_id, status, created, time(rng.randrange(24), rng.randrange(60), rng.randrange(60)),
+                         sentence(rng, rng.randint(4, 9))[:-1][:100], sentence(rng, rng.randint(10, 18))[:150],
+                         topics, rng.choice(thumbnails) if rng.random() < 0.9 else None, content, content_text))
+            assignments.extend((article_id, topic) for topic in topics)
+
+        with db.transaction() as cursor:
+            execute_values(cursor,
+                           "INSERT INTO articles(article_id, status, date_created, time_created, title, "
+                           "short_description, topics, thumbnail, content, content_text) "
+                           "VALUES %s",
+                           rows, template="(%s, %s, %s, %s, %s, %s, %s::varchar[], %s::bytea, %s, %s)")
+            execute_values(cursor,
+                           "INSERT INTO topic_assignments(article_id, topic) "
+                           "VALUES %s", assignments)
+
+    # counts, related articles and likes go through the same code the app uses to maintain them
+    db.rebuild_topic_store()
+    db.rebuild_related_articles()
+
+    likes = set()
+    for article_id in published:
+        # likes follow a long tail, most articles get a few and some get many
+        for _ in range(min(users, int(rng.expovariate(1 / likes_per_article)))):
+            likes.add((article_id, rng.randrange(users)))
+    likes = sorted(likes)
+    for offset in range(0, len(likes), 5000):
+        db.apply_likes(likes[offset:offset + 5000], [])
+
+    with db.transaction() as cursor:
+        db._bump_content_version(cursor)
+
+    return {
+        'seed': seed_value,
+        'published_ids': published,
+        'draft_ids': drafts,
+        'topics': TOPICS,
+        'words': WORDS,
+        'users': users,
+    }
+
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    with open(path, 'w') as fh:
+        json.dump(manifest, fh)
+
+
+def load_manifest(path=MANIFEST_PATH):
+    with open(path) as fh:
+        return json.load(fh)
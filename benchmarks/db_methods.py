@@ -0,0 +1,71 @@
+import random
+import time
+
+from .stats import summarize
+
+
+def cases(db, manifest, rng):
+    """Returns {name: callable} with one call of each ArticleDb method the app uses on a request, with arguments
+    drawn from the seeded corpus"""
+    published = manifest['published_ids']
+    drafts = manifest['draft_ids'] or published
+    topics = manifest['topics']
+    words = manifest['words']
+    users = manifest['users']
+
+    def article_id():
+        return rng.choice(published)
+
+    def deep_cursor():
+        # the cursor of a page halfway down the listing
+        rows, cursor = db.get_article_summary_page('publish', limit=len(published) // 2 or 1)
+        return cursor
+
+    middle = deep_cursor()
+
+    def like_round_trip():
+        article, user = article_id(), users + rng.randrange(users)
+        db.add_like(article, user)
+        db.remove_like(article, user)
+
+    return {
+        'get_article': lambda: db.get_article(article_id()),
+        'get_article_version': lambda: db.get_article_version(article_id()),
+        'get_content_version': db.get_content_version,
+        'check_article_exists': lambda: db.check_article_exists(article_id()),
+        'get_article_summary_page': lambda: db.get_article_summary_page('publish'),
+        'get_article_summary_page_deep': lambda: db.get_article_summary_page('publish', cursor=middle),
+        'get_article_summary_page_topic': lambda: db.get_article_summary_page('publish', topic=rng.choice(topics)),
+        'get_article_summary_page_drafts': lambda: db.get_article_summary_page('draft'),
+        'search_article_page': lambda: db.search_article_page('publish', rng.choice(words)),
+        'search_article_page_prefix': lambda: db.search_article_page('publish', rng.choice(words)[:3]),
+        'get_related_article_summaries': lambda: db.get_related_article_summaries(article_id()),
+        'get_like_count': lambda: db.get_like_count(article_id(), rng.randrange(users)),
+        'add_like_remove_like': like_round_trip,
+        'get_topics': db.get_topics,
+        'get_thumbnail': lambda: db.get_thumbnail(article_id()),
+        'get_article_images': lambda: db.get_article_images(article_id()),
+        'get_article_image_digests': lambda: db.get_article_image_digests(rng.choice(drafts)),
+        'new_article_id': db.new_article_id,
+        'get_article_summaries_drafts': lambda: db.get_article_summaries('draft'),
+    }
+
+
+def run(db, manifest, iterations=200, warmup=20, only=None, seed_value=1):
+    """Calls every case warmup times, then times iterations calls of it. Returns {case: summary}"""
+    rng = random.Random(seed_value)
+    results = {}
+    for name, call in cases(db, manifest, rng).items():
+        if only and name not in only:
+            continue
+
+        for _ in range(warmup):
+            call()
+
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+        results[name] = summarize(timings, elapsed=sum(timings))
+    return results
@@ -0,0 +1,117 @@
+import http.client
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import quote, urlencode, urlsplit
+
+from .stats import summarize
+
+# share of requests each route gets, roughly what the access logs of a small blog look like
+DEFAULT_MIX = {
+    'front_page': 20,
+    'read_article': 50,
+    'browse_topic': 12,
+    'browse_search': 10,
+    'like_article': 8,
+}
+
+
+class RequestFactory:
+    """Builds the path of the next request of each kind from the seeded corpus"""
+
+    def __init__(self, manifest, rng):
+        self.manifest = manifest
+        self.rng = rng
+
+    def front_page(self):
+        return '/'
+
+    def read_article(self):
+        return '/blog/read/%d' % self._article_id()
+
+    def browse_topic(self):
+        return '/blog/browse/topic/' + quote(self.rng.choice(self.manifest['topics']))
+
+    def browse_search(self):
+        words = self.rng.sample(self.manifest['words'], self.rng.randint(1, 2))
+        # partly typed words, like the requests search as you type sends
+        if self.rng.random() < 0.5:
+            words[-1] = words[-1][:max(2, len(words[-1]) // 2)]
+        return '/blog/browse/search/' + quote(' '.join(words))
+
+    def like_article(self):
+        return '/blog/like_article?' + urlencode({'article_id': self._article_id(),
+                                                  'user_id': self.rng.randrange(self.manifest['users']),
+                                                  'user_liked': self.rng.choice(['False', 'True'])})
+
+    def _article_id(self):
+        # a few articles get most of the traffic
+        ids = self.manifest['published_ids']
+        return ids[min(len(ids) - 1, int(self.rng.paretovariate(1.2)) - 1)]
+
+
+def run(url, manifest, concurrency=8, duration=30.0, requests=None, mix=None, seed_value=1, timeout=30.0):
+    """Sends requests to the server at url from concurrency keep-alive connections, for duration seconds or until
+    requests were sent. Returns {route: summary} with an 'all' entry covering every request"""
+    mix = mix or DEFAULT_MIX
+    target = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if target.scheme == 'https' else http.client.HTTPConnection
+
+    lock = threading.Lock()
+    latencies = defaultdict(list)
+    sizes = defaultdict(list)
+    errors = defaultdict(int)
+    sent = [0]
+    deadline = time.monotonic() + duration
+
+    def claim():
+        with lock:
+            if requests is not None and sent[0] >= requests:
+                return False
+            sent[0] += 1
+            return requests is not None or time.monotonic() < deadline
+
+    def worker(number):
+        rng = random.Random('%s-%s' % (seed_value, number))
+        factory = RequestFactory(manifest, rng)
+        routes, weights = zip(*mix.items())
+        connection = connection_class(target.netloc, timeout=timeout)
+
+        while claim():
+            route = rng.choices(routes, weights)[0]
+            path = target.path.rstrip('/') + getattr(factory, route)()
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+                response = connection.getresponse()
+                body = response.read()
+                ok = response.status < 400
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = connection_class(target.netloc, timeout=timeout)
+                body, ok = b'', False
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                if ok:
+                    latencies[route].append(elapsed)
+                    sizes[route].append(len(body))
+                else:
+                    errors[route] += 1
+        connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(number,), daemon=True) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = {route: summarize(latencies[route], sizes[route], errors[route], elapsed)
+               for route in mix if latencies[route] or errors[route]}
+    results['all'] = summarize([value for values in latencies.values() for value in values],
+                               [value for values in sizes.values() for value in values],
+                               sum(errors.values()), elapsed)
+    return results
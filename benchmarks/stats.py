@@ -0,0 +1,59 @@
+import json
+import math
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(seconds, sizes=(), errors=0, elapsed=None):
+    """Latency percentiles in milliseconds, throughput and response sizes of one series of samples"""
+    seconds = sorted(seconds)
+    summary = {'count': len(seconds), 'errors': errors}
+    for pct in PERCENTILES:
+        summary['p%d_ms' % pct] = round(percentile(seconds, pct) * 1000, 3)
+    summary['mean_ms'] = round(sum(seconds) * 1000 / len(seconds), 3) if seconds else 0.0
+    if elapsed:
+        summary['per_second'] = round(len(seconds) / elapsed, 1)
+    if sizes:
+        summary['mean_bytes'] = round(sum(sizes) / len(sizes))
+        summary['total_bytes'] = sum(sizes)
+    return summary
+
+
+def print_table(results, columns):
+    """Prints {name: summary} as an aligned table with one row per name"""
+    header = ['name'] + list(columns)
+    rows = [[name] + [str(summary.get(column, '')) for column in columns] for name, summary in results.items()]
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+
+    print('  '.join(cell.ljust(width) if i == 0 else cell.rjust(width)
+                    for i, (cell, width) in enumerate(zip(header, widths))))
+    for row in rows:
+        print('  '.join(cell.ljust(width) if i == 0 else cell.rjust(width)
+                        for i, (cell, width) in enumerate(zip(row, widths))))
+
+
+def save(results, path):
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+
+
+def regressions(results, baseline_path, metric='p95_ms', threshold=0.2):
+    """Returns (name, baseline, current) for every series whose metric got slower than the baseline by more than
+    threshold, as a fraction"""
+    with open(baseline_path) as fh:
+        baseline = json.load(fh)
+
+    slower = []
+    for name, summary in results.items():
+        before = baseline.get(name, {}).get(metric)
+        if before and summary.get(metric, 0) > before * (1 + threshold):
+            slower.append((name, before, summary[metric]))
+    return slower
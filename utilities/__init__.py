@@ -1 +1,15 @@
-from .articles_db import ArticleDb
\ No newline at end of file
+from .articles_db import ArticleDb
+from .async_db import AsyncArticleDb, BlockingReads
+from .bulk import export_content, import_content
+from .compression import ResponseCompressor
+from .image_store import DbImageStore, FileImageStore, image_store_from_url, migrate_article_images
+from .images import IMAGE_MIMETYPES, UnsupportedImage, image_mimetype
+from .like_buffer import LikeBuffer
+from .metrics import Metrics
+from .migrations import MIGRATIONS, migrate, schema_version
+from .page_cache import LRUCache, RedisCache, page_cache_from_url
+from .pagination import page_limit
+from .queries import QueryRegistry
+from .search import highlight
+from .snapshots import DirectorySnapshots, MemorySnapshots, Prerenderer, snapshot_store_from_url
+from .template_cache import TemplateCache
\ No newline at end of file
@@ -1,348 +1,1152 @@
+import base64
+import functools
+import itertools
 import psycopg2
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
+from psycopg2.extras import execute_values
+from .db_pool import ConnectionPool
+from .metrics import InstrumentedCursor
+from .images import decode_legacy_base64
+from .pagination import DEFAULT_LIMIT, decode_cursor, encode_cursor
+from .queries import QueryRegistry
+from .replicas import REPLICA_ERRORS, ReplicaSet
+from .search import HEADLINE_OPTIONS, split_prefix
+
+# columns needed to render an article card. Positions match the full article rows, with thumbnail replaced by a flag
+# so listings never pull content or image blobs
+SUMMARY_COLUMNS = ("x.article_id, status, date_created, time_created, date_updated, time_updated, title, "
+                   "short_description, x.topics, thumbnail IS NOT NULL AS has_thumbnail ")
+
+# topics are denormalized onto articles so listings and single fetches never aggregate topic_assignments
+SUMMARY_FROM = "FROM articles x "
+
+NEWEST_FIRST = "ORDER BY date_created DESC, time_created DESC, x.article_id DESC "
+
+# title matches are weighted above body matches when search results are ranked
+SEARCH_VECTOR = ("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                 "setweight(to_tsvector('english', coalesce(content_text, '')), 'B')")
+
+# number of precomputed neighbours stored per article, related articles are sampled from these
+RELATED_ARTICLES_KEPT = 20
+
+# queries of the public read path, shared with AsyncArticleDb
+ARTICLE_QUERY = ("SELECT article_id, status, date_created, time_created, date_updated, time_updated, title, "
+                 "short_description, topics, thumbnail IS NOT NULL, content "
+                 "FROM articles "
+                 "WHERE article_id=%s ")
+
+ARTICLE_VERSION_QUERY = ("SELECT x.status, coalesce(x.date_updated + x.time_updated, x.date_created + x.time_created), "
+                         "v.version, v.updated_at "
+                         "FROM articles x "
+                         "CROSS JOIN content_version v "
+                         "WHERE x.article_id = %s")
+
+RELATED_QUERY = ("SELECT " + SUMMARY_COLUMNS +
+                 "FROM related_articles AS r "
+                 "JOIN articles AS x ON x.article_id = r.related_id "
+                 "WHERE r.article_id = %s AND x.status = 'publish' "
+                 "ORDER BY r.score DESC "
+                 "LIMIT %s")
+
+LIKE_COUNT_QUERY = ("SELECT like_count, EXISTS( "
+                        "SELECT 1 "
+                        "FROM article_likes "
+                        "WHERE article_id = %s AND user_id = %s) "
+                    "FROM articles "
+                    "WHERE article_id = %s")
+
+TOPICS_QUERY = ("SELECT topic, published_count "
+                "FROM topic_counts "
+                "WHERE published_count > 0 "
+                "ORDER BY topic")
+
+CONTENT_VERSION_QUERY = ("SELECT version, updated_at "
+                         "FROM content_version")
+
+IMAGE_QUERY = ("SELECT file_name, md5(image), date_uploaded, "
+               "CASE WHEN md5(image) = ANY(%s) THEN NULL ELSE image END "
+               "FROM article_imgs "
+               "WHERE image_id = %s AND image IS NOT NULL")
+
+THUMBNAIL_QUERY = ("SELECT md5(thumbnail), "
+                   "coalesce(date_updated + time_updated, date_created + time_created), "
+                   "CASE WHEN md5(thumbnail) = ANY(%s) THEN NULL ELSE thumbnail END "
+                   "FROM articles "
+                   "WHERE article_id = %s AND thumbnail IS NOT NULL")
+
+IMAGE_BLOB_QUERY = ("SELECT variant, mimetype, date_created, data "
+                    "FROM image_blobs "
+                    "WHERE digest = %s AND variant IN (%s, 'original') "
+                    "ORDER BY variant = 'original' "
+                    "LIMIT 1")
+
+ADD_LIKE_QUERY = ("WITH "
+                      "liked AS ( "
+                          "INSERT INTO article_likes(date_liked, article_id, user_id) "
+                          "SELECT %s, article_id, %s "
+                          "FROM articles "
+                          "WHERE article_id = %s "
+                          "ON CONFLICT (article_id, user_id) DO NOTHING "
+                          "RETURNING 1) "
+                  "UPDATE articles "
+                  "SET like_count = like_count + (SELECT COUNT(*) FROM liked) "
+                  "WHERE article_id = %s "
+                  "RETURNING like_count, TRUE")
+
+REMOVE_LIKE_QUERY = ("WITH "
+                         "unliked AS ( "
+                             "DELETE "
+                             "FROM article_likes "
+                             "WHERE article_id = %s AND user_id = %s "
+                             "RETURNING 1) "
+                     "UPDATE articles "
+                     "SET like_count = like_count - (SELECT COUNT(*) FROM unliked) "
+                     "WHERE article_id = %s "
+                     "RETURNING like_count, FALSE")
+
+# the hot queries, prepared on each connection the first time it runs them. Listing and search pages are built at
+# runtime and registered under a name per shape the first time they run
+HOT_QUERIES = {
+    'article': ARTICLE_QUERY,
+    'article_version': ARTICLE_VERSION_QUERY,
+    'related_articles': RELATED_QUERY,
+    'like_count': LIKE_COUNT_QUERY,
+    'topics': TOPICS_QUERY,
+    'content_version': CONTENT_VERSION_QUERY,
+    'image': IMAGE_QUERY,
+    'thumbnail': THUMBNAIL_QUERY,
+    'image_blob': IMAGE_BLOB_QUERY,
+    'add_like': ADD_LIKE_QUERY,
+    'remove_like': REMOVE_LIKE_QUERY,
+}
+
+
+def summary_query(status, cursor=None, topic=None, search=None):
+    """Builds the newest-first summary query shared by the paged and streaming listings"""
+    conditions = ["status=%s"]
+    args = [status]
+
+    if topic is not None:
+        conditions.append("x.article_id IN (SELECT article_id FROM topic_assignments WHERE topic = %s)")
+        args.append(topic)
+    if search is not None:
+        conditions.append("x.text_searchable_index @@ websearch_to_tsquery('english', %s)")
+        args.append(search)
+    if cursor is not None:
+        conditions.append("(date_created, time_created, x.article_id) < (%s, %s, %s)")
+        args.extend(decode_cursor(cursor))
+
+    query = ("SELECT " + SUMMARY_COLUMNS + SUMMARY_FROM +
+             "WHERE " + " AND ".join(conditions) + " " + NEWEST_FIRST)
+    return query, args
+
+
+def summary_page(rows, limit):
+    """Splits the limit + 1 rows fetched for a page into (rows, next_cursor)"""
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][2], rows[-1][3], rows[-1][0])
+
+    return rows, next_cursor
+
+
+def replica_read(method):
+    """Marks an ArticleDb method that only reads. With replicas configured it runs on one of them, unless the thread
+    is inside a transaction or wrote within the last sticky_seconds. When the replica fails it runs again on the
+    primary"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        reading = getattr(self._local, 'reading', False)
+        self._local.reading = True
+        try:
+            replica = self._choose_replica()
+            if replica is not None:
+                try:
+                    with self._replica_connection(replica) as con:
+                        self._local.read_con = con
+                        try:
+                            return method(self, *args, **kwargs)
+                        finally:
+                            self._local.read_con = None
+                except REPLICA_ERRORS:
+                    pass
+
+            return method(self, *args, **kwargs)
+        finally:
+            self._local.reading = reading
+
+    return wrapper
+
+
+def primary_read(method):
+    """Marks an ArticleDb method that only reads but has to see the primary, such as a check made before a write. It
+    does not count as a write, so it never keeps the session on the primary"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        reading = getattr(self._local, 'reading', False)
+        self._local.reading = True
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._local.reading = reading
+
+    return wrapper
 
-class ArticleDb:
-    def __init__(self, connection_string):
-        self.con = psycopg2.connect(connection_string)
-        self.cursor = self.con.cursor()
-        self.create_article_table()
-        self.create_gin_index()
-        self.create_article_images_table()
-        self.create_topic_assignments_table()
-        self.create_likes_table()
 
+class ArticleDb:
+    def __init__(self, connection_string, min_size=1, max_size=1, timeout=30.0, related_text_weight=0.0,
+                 prepare_statements=True, replicas=(), replica_selection='round_robin', replica_eject_seconds=30.0,
+                 replica_max_lag=None, sticky_seconds=5.0):
+        # a pool with max_size=1 behaves like the original single shared connection
+        self.pool = ConnectionPool(connection_string, min_size=min_size, max_size=max_size, timeout=timeout)
+        # methods marked with replica_read go to the replicas, everything else to the primary. A thread that wrote
+        # keeps reading from the primary for sticky_seconds so it sees its own writes
+        self.replicas = ReplicaSet(replicas, replica_selection, replica_eject_seconds, replica_max_lag,
+                                   min_size=min_size, max_size=max_size, timeout=timeout) if replicas else None
+        self.sticky_seconds = sticky_seconds
+        self._local = threading.local()
+        self._stream_ids = itertools.count()
+        # weight of title/body text similarity next to shared topics when ranking related articles, 0 disables it
+        self.related_text_weight = related_text_weight
+
+        # called with (label, seconds, rows, bytes fetched, query) after every statement
+        self.observers = []
+
+        # turn prepare_statements off behind a pooler that does not keep sessions, such as pgbouncer in transaction mode
+        self.queries = QueryRegistry(prepare=prepare_statements)
+        for name, sql in HOT_QUERIES.items():
+            self.queries.register(name, sql)
+
+        # connections open on first use and the schema is created by the migrations in migrations.py, run with
+        # `flask migrate`, so constructing an ArticleDb does no database work
+
+    def checkout(self):
+        """Pins a pooled primary connection to the current thread (request) until release() is called. The
+        connection is taken from the pool on first use, so a request served from replicas never holds one"""
+        self._local.pin = True
+
+    def release(self):
+        """Returns the connection pinned by checkout() to the pool and forgets the thread's recent writes"""
+        self._local.pin = False
+        self._local.primary_until = 0.0
+        self._local.wrote = False
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            self._local.con = None
+            self.pool.putconn(con)
+
+    def stick_to_primary(self, seconds):
+        """Sends this thread's reads to the primary for the next seconds, for a session that wrote in an earlier
+        request"""
+        self._local.primary_until = max(getattr(self._local, 'primary_until', 0.0), time.monotonic() + seconds)
+
+    def wrote(self):
+        """Returns True when this thread committed a write on the primary since checkout()"""
+        return getattr(self._local, 'wrote', False)
+
+    def pool_stats(self):
+        stats = self.pool.stats()
+        if self.replicas is not None:
+            stats['replicas'] = self.replicas.stats()
+        return stats
+
+    def _choose_replica(self):
+        if self.replicas is None or getattr(self._local, 'cursor', None) is not None:
+            return None
+        if time.monotonic() < getattr(self._local, 'primary_until', 0.0):
+            return None
+        return self.replicas.choose()
+
+    @contextmanager
+    def _replica_connection(self, replica):
+        """Yields a connection of replica, ejecting the replica when it cannot be reached or drops the connection"""
+        try:
+            con = replica.pool.getconn()
+        except REPLICA_ERRORS as error:
+            self.replicas.eject(replica, error)
+            raise
+
+        broken = False
+        try:
+            yield con
+        except BaseException as error:
+            if not con.closed:
+                try:
+                    con.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if con.closed or broken:
+                broken = True
+                self.replicas.eject(replica, error)
+            raise
+        finally:
+            replica.pool.putconn(con, broken=broken)
+
+    @contextmanager
+    def connection(self):
+        """Yields the connection pinned to this thread or checks one out of the pool for the duration of the block"""
+        read_con = getattr(self._local, 'read_con', None)
+        if read_con is not None:
+            # a replica_read method, its replica connection is owned by the wrapper
+            yield read_con
+            return
+
+        pinned = getattr(self._local, 'con', None)
+        if pinned is None and getattr(self._local, 'pin', False):
+            pinned = self._local.con = self.pool.getconn()
+        con = pinned if pinned is not None else self.pool.getconn()
+        broken = False
+        try:
+            yield con
+        except BaseException:
+            if con.closed:
+                broken = True
+            else:
+                try:
+                    con.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+        finally:
+            if broken:
+                # drop the dead connection, the pool reconnects on the next checkout
+                if pinned is not None:
+                    self._local.con = None
+                self.pool.putconn(con, broken=True)
+            elif pinned is None:
+                self.pool.putconn(con)
+
+    @contextmanager
+    def transaction(self):
+        """Yields a cursor and commits when the block exits, rolling back on errors. Nested calls share the outer
+        transaction so a method can call other methods without committing half of its work"""
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is not None:
+            yield cursor
+            return
+
+        with self.connection() as con:
+            with con.cursor(cursor_factory=InstrumentedCursor) as cursor:
+                cursor.observers = self.observers
+                self._local.cursor = cursor
+                try:
+                    yield cursor
+                finally:
+                    self._local.cursor = None
+            con.commit()
+
+        # methods marked replica_read or primary_read only read
+        if con is not getattr(self._local, 'read_con', None) and not getattr(self._local, 'reading', False):
+            self._local.wrote = True
+            if self.replicas is not None:
+                # replicas may not have this write yet
+                self.stick_to_primary(self.sticky_seconds)
+
+    def stream(self, query, args, batch_size=100, read_only=False):
+        """Runs query on a server-side cursor and yields its rows, holding at most batch_size rows in memory. With
+        read_only=True the rows may come from a replica"""
+        replica = self._choose_replica() if read_only else None
+        if replica is not None:
+            started = False
+            try:
+                with self._replica_connection(replica) as con:
+                    for row in self._stream_rows(con, query, args, batch_size):
+                        started = True
+                        yield row
+                return
+            except REPLICA_ERRORS:
+                # rows already sent can not be taken back, only a stream that never started moves to the primary
+                if started:
+                    raise
+
+        with self.connection() as con:
+            yield from self._stream_rows(con, query, args, batch_size)
+
+    def _stream_rows(self, con, query, args, batch_size):
+        # WITH HOLD keeps the cursor valid if another query on this connection commits mid-iteration
+        with con.cursor(name='stream_%d' % next(self._stream_ids), withhold=True,
+                        cursor_factory=InstrumentedCursor) as cursor:
+            cursor.observers = self.observers
+            cursor.execute(query, args)
+            # fetched batch by batch rather than iterated, so the fetches are timed like any other query
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        con.commit()
 
     def create_article_table(self):
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS articles( "
-                            "article_id INT PRIMARY KEY, "
-                            "status VARCHAR(50) NOT NULL, "
-                            "date_created DATE NOT NULL, "
-                            "time_created TIME NOT NULL, "
-                            "date_updated DATE, "
-                            "time_updated TIME, "
-                            "title VARCHAR(100), "
-                            "short_description VARCHAR(150), "
-                            "thumbnail BYTEA,"
-                            "content TEXT,"
-                            "content_text TEXT,"
-                            "text_searchable_index tsvector "
-                            "GENERATED ALWAYS AS (to_tsvector('english', coalesce(title, '') || ' ' || coalesce(content_text, ''))) STORED)")
+        with self.transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS articles( "
+                           "article_id INT PRIMARY KEY, "
+                           "status VARCHAR(50) NOT NULL, "
+                           "date_created DATE NOT NULL, "
+                           "time_created TIME NOT NULL, "
+                           "date_updated DATE, "
+                           "time_updated TIME, "
+                           "title VARCHAR(100), "
+                           "short_description VARCHAR(150), "
+                           "thumbnail BYTEA,"
+                           "content TEXT,"
+                           "content_text TEXT,"
+                           "text_searchable_index tsvector "
+                           "GENERATED ALWAYS AS (" + SEARCH_VECTOR + ") STORED)")
 
     def create_article_images_table(self):
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS article_imgs( "
-                            "image_id SERIAL PRIMARY KEY, "
-                            "article_id INT,"
-                            "id_fn TEXT UNIQUE, "
-                            "file_name TEXT NOT NULL,"
-                            "image BYTEA)")
+        with self.transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS article_imgs( "
+                           "image_id SERIAL PRIMARY KEY, "
+                           "article_id INT,"
+                           "id_fn TEXT UNIQUE, "
+                           "file_name TEXT NOT NULL,"
+                           "image BYTEA)")
+            # used as Last-Modified when images are served over http
+            cursor.execute("ALTER TABLE article_imgs "
+                           "ADD COLUMN IF NOT EXISTS date_uploaded TIMESTAMP NOT NULL DEFAULT now()")
+
+    def create_image_blobs_table(self):
+        """creates the content addressed image store, one row per image digest and size variant"""
+        with self.transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS image_blobs( "
+                           "digest CHAR(64) NOT NULL, "
+                           "variant VARCHAR(16) NOT NULL, "
+                           "mimetype VARCHAR(32) NOT NULL, "
+                           "width INT, "
+                           "height INT, "
+                           "byte_size INT NOT NULL, "
+                           "data BYTEA, "
+                           "date_created TIMESTAMP NOT NULL DEFAULT now(), "
+                           "PRIMARY KEY (digest, variant))")
+            # article images uploaded to the store only reference it, image stays NULL
+            cursor.execute("ALTER TABLE article_imgs "
+                           "ADD COLUMN IF NOT EXISTS digest CHAR(64)")
 
     def create_topic_assignments_table(self):
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS topic_assignments( "
-                            "id SERIAL PRIMARY KEY, "
-                            "article_id INT REFERENCES articles(article_id),"
-                            "topic VARCHAR(20) NOT NULL)")
+        with self.transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS topic_assignments( "
+                           "id SERIAL PRIMARY KEY, "
+                           "article_id INT REFERENCES articles(article_id),"
+                           "topic VARCHAR(20) NOT NULL)")
+
+            cursor.execute("SELECT to_regclass('topic_assignments_article_topic_key') IS NULL")
+            if cursor.fetchone()[0]:
+                # older versions could assign the same topic twice, keep the first row of each pair
+                cursor.execute("DELETE FROM topic_assignments a "
+                               "USING topic_assignments b "
+                               "WHERE a.article_id = b.article_id AND a.topic = b.topic AND a.id > b.id")
+                cursor.execute("CREATE UNIQUE INDEX topic_assignments_article_topic_key "
+                               "ON topic_assignments(article_id, topic);")
 
     def create_likes_table(self):
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS article_likes( "
-                            "like_id SERIAL PRIMARY KEY, "
-                            "date_liked DATE NOT NULL, "
-                            "article_id INT REFERENCES articles(article_id), "
-                            "user_id INT)") # change user_id in final app to avoid errors
+        with self.transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS article_likes( "
+                           "like_id SERIAL PRIMARY KEY, "
+                           "date_liked DATE NOT NULL, "
+                           "article_id INT REFERENCES articles(article_id), "
+                           "user_id INT)") # change user_id in final app to avoid errors
+
+            cursor.execute("SELECT to_regclass('article_likes_article_user_key') IS NULL")
+            if cursor.fetchone()[0]:
+                # the old check-then-insert could race into duplicate likes, keep the first one
+                cursor.execute("DELETE FROM article_likes a "
+                               "USING article_likes b "
+                               "WHERE a.article_id = b.article_id AND a.user_id = b.user_id AND a.like_id > b.like_id")
+                cursor.execute("CREATE UNIQUE INDEX article_likes_article_user_key "
+                               "ON article_likes(article_id, user_id);")
+
+            cursor.execute("SELECT NOT EXISTS(SELECT 1 "
+                           "FROM information_schema.columns "
+                           "WHERE table_name = 'articles' AND column_name = 'like_count')")
+            backfill = cursor.fetchone()[0]
+
+            # maintained by add_like/remove_like so reading the count never scans article_likes
+            cursor.execute("ALTER TABLE articles ADD COLUMN IF NOT EXISTS like_count INT NOT NULL DEFAULT 0")
+            if backfill:
+                cursor.execute("UPDATE articles x "
+                               "SET like_count = (SELECT COUNT(*) "
+                                                 "FROM article_likes l "
+                                                 "WHERE l.article_id = x.article_id)")
 
     def create_gin_index(self):
         """creates the gin index on articles table to improve article search speeds"""
-
-        self.cursor.execute("CREATE INDEX IF NOT EXISTS textsearch_idx ON articles USING GIN(text_searchable_index);")
-        self.con.commit()
-
-
+        with self.transaction() as cursor:
+            cursor.execute("SELECT generation_expression "
+                           "FROM information_schema.columns "
+                           "WHERE table_name = 'articles' AND column_name = 'text_searchable_index'")
+            row = cursor.fetchone()
+            if row is not None and 'setweight' not in (row[0] or ''):
+                # older tables gave title and body the same weight, regenerating drops the old index with the column
+                cursor.execute("ALTER TABLE articles DROP COLUMN text_searchable_index")
+                cursor.execute("ALTER TABLE articles ADD COLUMN text_searchable_index tsvector "
+                               "GENERATED ALWAYS AS (" + SEARCH_VECTOR + ") STORED")
+
+            cursor.execute("CREATE INDEX IF NOT EXISTS textsearch_idx ON articles USING GIN(text_searchable_index);")
+
+
+    def create_listing_indexes(self):
+        """creates the indexes that let keyset pages start at any position without scanning the rows before it"""
+        with self.transaction() as cursor:
+            cursor.execute("CREATE INDEX IF NOT EXISTS articles_status_created_idx "
+                           "ON articles(status, date_created DESC, time_created DESC, article_id DESC);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS topic_assignments_topic_idx "
+                           "ON topic_assignments(topic, article_id);")
+
+    def create_topic_store(self):
+        """creates the per-article topic arrays and per-topic published counts, backfilling them the first time"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT to_regclass('topic_counts') IS NULL")
+            backfill = cursor.fetchone()[0]
+
+            cursor.execute("ALTER TABLE articles ADD COLUMN IF NOT EXISTS topics VARCHAR(20)[] NOT NULL DEFAULT '{}'")
+            cursor.execute("CREATE TABLE IF NOT EXISTS topic_counts( "
+                           "topic VARCHAR(20) PRIMARY KEY, "
+                           "published_count INT NOT NULL DEFAULT 0)")
+            # the unique (article_id, topic) index also serves lookups by article_id
+            cursor.execute("DROP INDEX IF EXISTS topic_assignments_article_idx;")
+
+            if backfill:
+                self.rebuild_topic_store()
+
+    def rebuild_topic_store(self):
+        """Recomputes every article's topic array and the per-topic counts from topic_assignments"""
+        with self.transaction() as cursor:
+            cursor.execute("UPDATE articles x "
+                           "SET topics = ARRAY(SELECT topic "
+                                              "FROM topic_assignments t "
+                                              "WHERE t.article_id = x.article_id "
+                                              "ORDER BY id)")
+            cursor.execute("DELETE FROM topic_counts")
+            cursor.execute("INSERT INTO topic_counts(topic, published_count) "
+                           "SELECT topic, COUNT(*) FILTER (WHERE articles.status = 'publish') "
+                           "FROM topic_assignments "
+                           "JOIN articles ON articles.article_id = topic_assignments.article_id "
+                           "GROUP BY topic")
+
+    def _adjust_topic_counts(self, cursor, topics, delta):
+        """Adds delta to the published count of every topic in topics"""
+        if topics and delta:
+            cursor.execute("INSERT INTO topic_counts(topic, published_count) "
+                           "SELECT topic, %s FROM unnest(%s::varchar[]) AS t(topic) "
+                           "ON CONFLICT (topic) DO UPDATE "
+                           "SET published_count = topic_counts.published_count + EXCLUDED.published_count",
+                           (delta, list(topics)))
+
+    def _set_status(self, cursor, article_id, status):
+        """Changes an article's status and moves its topics in or out of the published counts"""
+        cursor.execute("SELECT status, topics "
+                       "FROM articles "
+                       "WHERE article_id=%s "
+                       "FOR UPDATE", (article_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return
+
+        cursor.execute("UPDATE articles "
+                       "SET status=%s "
+                       "WHERE article_id=%s;", (status, article_id))
+
+        was_published, is_published = row[0] == 'publish', status == 'publish'
+        if was_published != is_published:
+            self._adjust_topic_counts(cursor, row[1], 1 if is_published else -1)
+            self._refresh_related_around(cursor, article_id)
+        # drafts are never on public pages, anything touching a published article changes them
+        if was_published or is_published:
+            self._bump_content_version(cursor)
+
+    def create_content_version_table(self):
+        """creates the single row content version, bumped whenever anything a public page shows may have changed"""
+        with self.transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS content_version( "
+                           "id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id), "
+                           "version BIGINT NOT NULL DEFAULT 1, "
+                           "updated_at TIMESTAMPTZ NOT NULL DEFAULT date_trunc('second', now()))")
+            cursor.execute("INSERT INTO content_version DEFAULT VALUES "
+                           "ON CONFLICT DO NOTHING")
+
+    def _bump_content_version(self, cursor):
+        # whole seconds, Last-Modified headers cannot carry anything finer
+        cursor.execute("UPDATE content_version "
+                       "SET version = version + 1, updated_at = date_trunc('second', now())")
+
+    @replica_read
+    def get_content_version(self):
+        """Returns (version, updated_at) of the published content"""
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'content_version')
+            return cursor.fetchone()
+
+    @replica_read
+    def get_article_version(self, article_id):
+        """Returns (status, last modified, content version, content updated_at) of an article without reading it"""
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'article_version', (article_id,))
+            return cursor.fetchone()
+
+    def create_related_articles_table(self):
+        """creates the precomputed related-articles index, filling it the first time"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT to_regclass('related_articles') IS NULL")
+            backfill = cursor.fetchone()[0]
+
+            cursor.execute("CREATE TABLE IF NOT EXISTS related_articles( "
+                           "article_id INT NOT NULL, "
+                           "related_id INT NOT NULL, "
+                           "score REAL NOT NULL, "
+                           "PRIMARY KEY (article_id, related_id))")
+            cursor.execute("CREATE INDEX IF NOT EXISTS related_articles_related_idx "
+                           "ON related_articles(related_id);")
+
+            if backfill:
+                self.rebuild_related_articles()
+
+    def rebuild_related_articles(self):
+        """Recomputes the related articles of every article"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT article_id FROM articles")
+            self.refresh_related_articles([row[0] for row in cursor.fetchall()])
+
+    def refresh_related_articles(self, article_ids):
+        """Recomputes the stored neighbour lists of article_ids. Neighbours are published articles ranked by the
+        number of topics they share, optionally plus their text similarity to the article's title"""
+        article_ids = sorted({int(x) for x in article_ids})
+        if not article_ids:
+            return
+
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM related_articles "
+                           "WHERE article_id = ANY(%s)", (article_ids,))
+            cursor.execute("WITH "
+                               "shared AS ( "
+                                   "SELECT mine.article_id, other.article_id AS related_id, COUNT(*) AS topics "
+                                   "FROM topic_assignments AS mine "
+                                   "JOIN topic_assignments AS other "
+                                       "ON other.topic = mine.topic AND other.article_id <> mine.article_id "
+                                   "WHERE mine.article_id = ANY(%(ids)s) "
+                                   "GROUP BY mine.article_id, other.article_id), "
+                               "scored AS ( "
+                                   "SELECT shared.article_id, shared.related_id, shared.topics + "
+                                       "CASE WHEN %(weight)s > 0 "
+                                       "THEN %(weight)s * ts_rank(a.text_searchable_index, to_tsquery('english', "
+                                           "replace(plainto_tsquery('english', coalesce(me.title, ''))::text, '&', '|'))) "
+                                       "ELSE 0 END AS score "
+                                   "FROM shared "
+                                   "JOIN articles AS a ON a.article_id = shared.related_id AND a.status = 'publish' "
+                                   "JOIN articles AS me ON me.article_id = shared.article_id), "
+                               "ranked AS ( "
+                                   "SELECT article_id, related_id, score, row_number() OVER ( "
+                                       "PARTITION BY article_id ORDER BY score DESC, related_id DESC) AS rank "
+                                   "FROM scored) "
+                           "INSERT INTO related_articles(article_id, related_id, score) "
+                           "SELECT article_id, related_id, score "
+                           "FROM ranked "
+                           "WHERE rank <= %(keep)s",
+                           {'ids': article_ids, 'weight': self.related_text_weight, 'keep': RELATED_ARTICLES_KEPT})
+
+    def _refresh_related_around(self, cursor, article_id):
+        """Recomputes the related articles of article_id after it was published, unpublished or retagged, and moves it
+        in the lists of other articles without recomputing them. It is scored once against every article sharing a
+        topic and enters a list only where it beats the lowest kept neighbour. A list it leaves keeps one neighbour
+        less until the next article enters it or rebuild_related_articles runs"""
+        article_id = int(article_id)
+        self.refresh_related_articles([article_id])
+
+        cursor.execute("DELETE FROM related_articles "
+                       "WHERE related_id = %s", (article_id,))
+        cursor.execute("WITH "
+                           "shared AS ( "
+                               "SELECT other.article_id, COUNT(*) AS topics "
+                               "FROM topic_assignments AS mine "
+                               "JOIN topic_assignments AS other "
+                                   "ON other.topic = mine.topic AND other.article_id <> mine.article_id "
+                               "WHERE mine.article_id = %(id)s "
+                               "GROUP BY other.article_id), "
+                           "scored AS ( "
+                               "SELECT shared.article_id, shared.topics + "
+                                   "CASE WHEN %(weight)s > 0 "
+                                   "THEN %(weight)s * ts_rank(me.text_searchable_index, to_tsquery('english', "
+                                       "replace(plainto_tsquery('english', coalesce(x.title, ''))::text, '&', '|'))) "
+                                   "ELSE 0 END AS score "
+                               "FROM shared "
+                               "JOIN articles AS me ON me.article_id = %(id)s AND me.status = 'publish' "
+                               "JOIN articles AS x ON x.article_id = shared.article_id) "
+                       "INSERT INTO related_articles(article_id, related_id, score) "
+                       "SELECT s.article_id, %(id)s, s.score "
+                       "FROM scored AS s "
+                       "WHERE (SELECT COUNT(*) FROM related_articles AS r WHERE r.article_id = s.article_id) < %(keep)s "
+                          "OR EXISTS(SELECT 1 "
+                                    "FROM related_articles AS r "
+                                    "WHERE r.article_id = s.article_id AND (r.score, r.related_id) < (s.score, %(id)s)) "
+                       "RETURNING article_id",
+                       {'id': article_id, 'weight': self.related_text_weight, 'keep': RELATED_ARTICLES_KEPT})
+        entered = [row[0] for row in cursor.fetchall()]
+
+        # the lists it entered that were full drop their lowest neighbour
+        if entered:
+            cursor.execute("DELETE FROM related_articles AS r "
+                           "USING (SELECT article_id, related_id, row_number() OVER ( "
+                                      "PARTITION BY article_id ORDER BY score DESC, related_id DESC) AS rank "
+                                  "FROM related_articles "
+                                  "WHERE article_id = ANY(%s)) AS ranked "
+                           "WHERE r.article_id = ranked.article_id AND r.related_id = ranked.related_id "
+                           "AND ranked.rank > %s", (entered, RELATED_ARTICLES_KEPT))
+
+    @primary_read
     def new_article_id(self):
-        self.cursor.execute("SELECT max(article_id) "
-                            "FROM articles ")
-
-        results = self.cursor.fetchone()[0]
-        if results == None:
-            results = 0
-        else:
-            # increment new id by 1
-            results = results + 1
-
-        return results
-
-    def add_article_image(self, article_id, unique_identifier, file_name, image):
-        """Adds article image to database and avoids adding duplicate images"""
-        self.cursor.execute("INSERT INTO article_imgs(article_id, id_fn, file_name, image) "
-                            "VALUES(%s, %s, %s, %s) "
-                            "ON CONFLICT (id_fn) DO NOTHING;", (article_id, unique_identifier, file_name, psycopg2.Binary(image)))
-
-        self.con.commit()
+        with self.transaction() as cursor:
+            cursor.execute("SELECT max(article_id) "
+                           "FROM articles ")
 
+            results = cursor.fetchone()[0]
+            if results == None:
+                results = 0
+            else:
+                # increment new id by 1
+                results = results + 1
+
+            return results
+
+    def add_article_image(self, article_id, unique_identifier, file_name, image=None, digest=None):
+        """Adds article image to database and avoids adding duplicate images. Images kept in the image store are
+        added by digest instead of bytes"""
+        with self.transaction() as cursor:
+            cursor.execute("INSERT INTO article_imgs(article_id, id_fn, file_name, image, digest) "
+                           "VALUES(%s, %s, %s, %s, %s) "
+                           "ON CONFLICT (id_fn) DO NOTHING;",
+                           (article_id, unique_identifier, file_name,
+                            psycopg2.Binary(image) if image is not None else None, digest))
+
+    def add_image_blob(self, digest, variant, mimetype, width, height, byte_size, data):
+        """Records one variant of a stored image. data is None when the bytes are kept outside the database"""
+        with self.transaction() as cursor:
+            cursor.execute("INSERT INTO image_blobs(digest, variant, mimetype, width, height, byte_size, data) "
+                           "VALUES(%s, %s, %s, %s, %s, %s, %s) "
+                           "ON CONFLICT (digest, variant) DO NOTHING;",
+                           (digest, variant, mimetype, width, height, byte_size,
+                            psycopg2.Binary(data) if data is not None else None))
+
+    @replica_read
+    def get_image_variants(self, digest):
+        """Returns (variant, mimetype, width, height, byte_size) for every stored variant of an image"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT variant, mimetype, width, height, byte_size "
+                           "FROM image_blobs "
+                           "WHERE digest = %s "
+                           "ORDER BY byte_size", (digest,))
+            return cursor.fetchall()
+
+    @replica_read
+    def get_image_blob(self, digest, variant):
+        """Returns (variant, mimetype, date_created, data) of an image variant, falling back to the original upload
+        when that variant was not generated"""
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'image_blob', (digest, variant))
+            return cursor.fetchone()
+
+    @replica_read
     def get_article_images(self, article_id):
-        self.cursor.execute("SELECT file_name, image "
-                            "FROM article_imgs "
-                            "WHERE article_id = %s; ", (article_id, ))
-
-        results = self.cursor.fetchall()
-
-        image_dict = {}
-
-        for image in results:
-            image_dict[image[0]] = bytes(image[1]).decode('utf-8')
-
-        return image_dict
+        with self.transaction() as cursor:
+            cursor.execute("SELECT file_name, image "
+                           "FROM article_imgs "
+                           "WHERE article_id = %s AND image IS NOT NULL; ", (article_id, ))
+
+            results = cursor.fetchall()
+
+            image_dict = {}
+
+            for image in results:
+                image_dict[image[0]] = base64.b64encode(bytes(image[1])).decode('utf-8')
+
+            return image_dict
+
+    @primary_read
+    def get_article_image_digests(self, article_id):
+        """Returns file name -> digest of the article's images kept in the image store"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT file_name, digest "
+                           "FROM article_imgs "
+                           "WHERE article_id = %s AND digest IS NOT NULL; ", (article_id, ))
+            return dict(cursor.fetchall())
+
+    @primary_read
+    def get_unstored_article_images(self, after_id, limit):
+        """Returns (image_id, image) for a batch of article images that are not in the image store yet"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT image_id, image "
+                           "FROM article_imgs "
+                           "WHERE image_id > %s AND digest IS NULL AND image IS NOT NULL "
+                           "ORDER BY image_id "
+                           "LIMIT %s", (after_id, limit))
+            return cursor.fetchall()
+
+    def set_article_image_digest(self, image_id, digest):
+        with self.transaction() as cursor:
+            cursor.execute("UPDATE article_imgs "
+                           "SET digest=%s "
+                           "WHERE image_id=%s;", (digest, image_id))
+
+    @primary_read
+    def get_article_contents(self, after_id, limit):
+        """Returns (article_id, content) for a batch of articles in id order"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT article_id, content "
+                           "FROM articles "
+                           "WHERE article_id > %s "
+                           "ORDER BY article_id "
+                           "LIMIT %s", (after_id, limit))
+            return cursor.fetchall()
+
+    def set_article_content(self, article_id, content):
+        with self.transaction() as cursor:
+            cursor.execute("UPDATE articles "
+                           "SET content=%s "
+                           "WHERE article_id=%s;", (content, article_id))
+
+    @replica_read
+    def get_image(self, image_id, etags=()):
+        """Returns (file_name, etag, last_modified, image) for an article image. image is None when its etag is in
+        etags, so a client with a current copy never pulls the blob over the wire"""
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'image', (list(etags), image_id))
+
+            return cursor.fetchone()
+
+    @replica_read
+    def get_thumbnail(self, article_id, etags=()):
+        """Returns (etag, last_modified, thumbnail) for an article. thumbnail is None when its etag is in etags"""
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'thumbnail', (list(etags), article_id))
+
+            return cursor.fetchone()
+
+    def convert_base64_images(self, batch_size=50):
+        """One-off migration that decodes thumbnails and article images stored as base64 text into raw bytes.
+        Returns the number of converted rows"""
+        converted = 0
+        # only rows whose first bytes are printable base64 characters are pulled for the full check
+        looks_base64 = "encode(substring({0} from 1 for 16), 'escape') ~ '^[A-Za-z0-9+/=\\s]+$'"
+
+        for table, key, column in (('articles', 'article_id', 'thumbnail'), ('article_imgs', 'image_id', 'image')):
+            last_id = -1
+            while True:
+                with self.transaction() as cursor:
+                    cursor.execute("SELECT " + key + ", " + column + " "
+                                   "FROM " + table + " "
+                                   "WHERE " + key + " > %s AND " + looks_base64.format(column) + " "
+                                   "ORDER BY " + key + " "
+                                   "LIMIT %s", (last_id, batch_size))
+                    rows = cursor.fetchall()
+
+                    for row_id, data in rows:
+                        raw = decode_legacy_base64(data)
+                        if raw is not None:
+                            cursor.execute("UPDATE " + table + " "
+                                           "SET " + column + "=%s "
+                                           "WHERE " + key + "=%s;", (psycopg2.Binary(raw), row_id))
+                            converted += 1
+
+                if len(rows) < batch_size:
+                    break
+                last_id = rows[-1][0]
+
+        return converted
 
     def add_article(self, article_id, status, date_created, time_created, title, short_description, topics, thumbnail, content, text_content):
+        with self.transaction() as cursor:
+            cursor.execute("INSERT INTO articles(article_id, status, date_created, time_created, title, short_description, thumbnail, content, content_text) "
+                           "VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s);",
+                           (article_id, status, date_created, time_created, title, short_description, psycopg2.Binary(thumbnail), content, text_content))
 
-
-        self.cursor.execute("INSERT INTO articles(article_id, status, date_created, time_created, title, short_description, thumbnail, content, content_text) "
-                            "VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s);",
-                            (article_id, status, date_created, time_created, title, short_description, psycopg2.Binary(thumbnail), content, text_content))
-
-        if topics[0] != '':
-            self.add_topics(article_id, topics)
-        self.con.commit()
+            if topics[0] != '':
+                self.add_topics(article_id, topics)
+            if status == 'publish':
+                self._bump_content_version(cursor)
 
     def update_article(self, article_id, status, date_updated, time_updated, title, short_description, topics, thumbnail, content, text_content):
-        self.add_topics(article_id, topics)
+        with self.transaction() as cursor:
+            self._set_status(cursor, article_id, status)
+            self.add_topics(article_id, topics)
 
-        self.cursor.execute("UPDATE articles "
-                            "SET status=%s, date_updated=%s, time_updated=%s, title=%s, short_description=%s, thumbnail=%s, content=%s, content_text=%s "
-                            "WHERE article_id=%s;", (status, date_updated, time_updated, title, short_description, psycopg2.Binary(thumbnail), content, text_content, article_id))
-        self.con.commit()
+            cursor.execute("UPDATE articles "
+                           "SET status=%s, date_updated=%s, time_updated=%s, title=%s, short_description=%s, thumbnail=%s, content=%s, content_text=%s "
+                           "WHERE article_id=%s;", (status, date_updated, time_updated, title, short_description, psycopg2.Binary(thumbnail), content, text_content, article_id))
 
     def update_article_no_thumb(self, article_id, status, date_updated, time_updated, title, short_description, topics,
                        content, text_content):
-        self.add_topics(article_id, topics)
-
-        self.cursor.execute("UPDATE articles "
-                            "SET status=%s, date_updated=%s, time_updated=%s, title=%s, short_description=%s, content=%s, content_text=%s "
-                            "WHERE article_id=%s;", (
-                            status, date_updated, time_updated, title, short_description,
-                            content, text_content, article_id))
-        self.con.commit()
-
-    def get_articles(self, status):
-        self.cursor.execute("SELECT x.article_id, status, date_created, time_created, date_updated, time_updated, title, short_description, y.topics, thumbnail, content "
-                                "FROM articles x "
-                                "LEFT JOIN ( SELECT article_id, array_agg(topic) as topics "
-                                    "FROM topic_assignments "
-                                    "GROUP BY article_id) "
-                                    "AS y ON x.article_id = y.article_id "
-                                "WHERE status=%s ", (status,))
-        results = self.cursor.fetchall()
-        return results
-
-
-    def query_articles_by_topic(self,status, topic):
-        self.cursor.execute("WITH "
-                                "articleTable (article_id, status, date_created, time_created, date_updated, time_updated, title, short_description, topics, thumbnail, content) "
-                                "AS ( "
-                                    "SELECT x.article_id, status, date_created, time_created, date_updated, time_updated, title, short_description, y.topics, thumbnail, content "
-                                    "FROM articles x "
-                                    "JOIN ( SELECT article_id, array_agg(topic) as topics " 
-                                        "FROM topic_assignments "
-                                        "GROUP BY article_id) "
-                                        "AS y ON x.article_id = y.article_id "
-                                    "WHERE status=%s "
-                                    "), "
-                                "topicTable (article_id) "
-                                "AS ( "
-                                    "SELECT article_id "
-                                    "FROM topic_assignments "
-                                    "WHERE topic = %s "
-                                ") "
-                            "SELECT tt.article_id, status, date_created, time_created, date_updated, time_updated, title, short_description, topics, thumbnail, content "
-                            "FROM topicTable AS tt "
-                            "LEFT JOIN articleTable AS at ON at.article_id = tt.article_id", (status, topic))
-        results = self.cursor.fetchall()
-        return results
-
-    def query_related_articles(self, status, topic, article_id):
-        self.cursor.execute("WITH "
-                                "articleTable (article_id, status, date_created, time_created, date_updated, time_updated, title, short_description, topics, thumbnail, content) "
-                                "AS ( "
-                                    "SELECT x.article_id, status, date_created, time_created, date_updated, time_updated, title, short_description, y.topics, thumbnail, content "
-                                    "FROM articles x "
-                                    "JOIN ( SELECT article_id, array_agg(topic) as topics " 
-                                        "FROM topic_assignments "
-                                        "GROUP BY article_id) "
-                                        "AS y ON x.article_id = y.article_id "
-                                    "WHERE status=%s "
-                                    "), "
-                                "topicTable (article_id) "
-                                "AS ( "
-                                    "SELECT article_id "
-                                    "FROM topic_assignments "
-                                    "WHERE topic = %s "
-                                ") "
-                            "SELECT tt.article_id, status, date_created, time_created, date_updated, time_updated, title, short_description, topics, thumbnail, content "
-                            "FROM topicTable AS tt "
-                            "LEFT JOIN articleTable AS at ON at.article_id = tt.article_id "
-                            "WHERE tt.article_id != %s"
-                            "ORDER BY RANDOM() "
-                            "LIMIT 5", (status, topic, article_id))
-        results = self.cursor.fetchall()
-        return results
-
-    def search_articles(self, status, search):
-        self.cursor.execute("SELECT x.article_id, status, date_created, time_created, date_updated, time_updated, title, short_description, y.topics, thumbnail, content " 
-                                "FROM articles AS x "
-                                "LEFT JOIN (SELECT article_id, array_agg(topic) as topics "
-                                    "FROM topic_assignments "
-                                    "GROUP BY article_id) "
-                                    "AS y ON x.article_id = y.article_id "
-                                "WHERE status=%s AND x.text_searchable_index @@ phraseto_tsquery('english', %s) "
-                                "ORDER BY date_created DESC ", (status, search))
-        results = self.cursor.fetchall()
-        return results
+        with self.transaction() as cursor:
+            self._set_status(cursor, article_id, status)
+            self.add_topics(article_id, topics)
 
+            cursor.execute("UPDATE articles "
+                           "SET status=%s, date_updated=%s, time_updated=%s, title=%s, short_description=%s, content=%s, content_text=%s "
+                           "WHERE article_id=%s;", (
+                                status, date_updated, time_updated, title, short_description,
+                                content, text_content, article_id))
+
+    @replica_read
+    def get_article_summaries(self, status):
+        """Returns the card fields of every article with status, newest first"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT " + SUMMARY_COLUMNS + SUMMARY_FROM +
+                           "WHERE status=%s " + NEWEST_FIRST, (status,))
+            return cursor.fetchall()
+
+    def iter_article_summaries(self, status, cursor=None, topic=None, search=None, batch_size=100):
+        """Streaming version of get_article_summary_page that yields every row after cursor without holding the
+        result in memory"""
+        query, args = summary_query(status, cursor, topic, search)
+        return self.stream(query, args, batch_size, read_only=True)
+
+    @replica_read
+    def get_article_summary_page(self, status, limit=DEFAULT_LIMIT, cursor=None, topic=None, search=None):
+        """Returns (rows, next_cursor) for one page of article summaries, newest first. cursor is the value returned
+        with the previous page and next_cursor is None on the last page. Pages are keyset based so a deep page costs
+        the same as the first one"""
+        query, args = summary_query(status, cursor, topic, search)
+        # one prepared statement per combination of filters
+        name = 'summary_page' + ''.join('_' + part for part, value in
+                                        (('topic', topic), ('search', search), ('after', cursor)) if value is not None)
+
+        with self.transaction() as cur:
+            # one extra row tells us whether there is a next page
+            self.queries.execute(cur, name, args + [limit + 1], sql=query + "LIMIT %s")
+            return summary_page(cur.fetchall(), limit)
+
+    @replica_read
+    def get_related_article_summaries(self, article_id, count=5):
+        """Returns up to count related articles, sampled from the article's precomputed neighbours so the selection
+        rotates between views without sorting the catalogue"""
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'related_articles', (article_id, RELATED_ARTICLES_KEPT))
+            results = cursor.fetchall()
+
+        return random.sample(results, min(count, len(results)))
+
+    @replica_read
+    def get_articles_related_to(self, article_id):
+        """Returns the ids of the published articles that list article_id among their related articles"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT r.article_id "
+                           "FROM related_articles AS r "
+                           "JOIN articles AS x ON x.article_id = r.article_id "
+                           "WHERE r.related_id = %s AND x.status = 'publish'", (article_id,))
+            return [row[0] for row in cursor.fetchall()]
+
+    @replica_read
+    def search_article_page(self, status, search, limit=DEFAULT_LIMIT, offset=0, prefix=True):
+        """Returns (rows, next_offset) for one page of search results, best match first. search takes the
+        websearch_to_tsquery syntax and with prefix=True its last word also matches longer words, for search as you
+        type. Rows are summaries followed by a highlighted snippet of the body, next_offset is None on the last page"""
+        head, tail = split_prefix(search) if prefix else (search, None)
+        query = "websearch_to_tsquery('english', %(head)s)"
+        if tail is not None:
+            query += " && to_tsquery('english', %(tail)s)"
+
+        # only the page is joined back for its columns, snippets are the slowest part so only the page gets them
+        sql = ("WITH "
+                   "q AS (SELECT " + query + " AS query), "
+                   "ranked AS ( "
+                       "SELECT x.article_id, ts_rank_cd(x.text_searchable_index, q.query) AS rank "
+                       "FROM articles x, q "
+                       "WHERE x.status = %(status)s AND x.text_searchable_index @@ q.query "
+                       "ORDER BY rank DESC, x.article_id DESC "
+                       "LIMIT %(limit)s OFFSET %(offset)s) "
+               "SELECT " + SUMMARY_COLUMNS +
+                      ", ts_headline('english', coalesce(x.content_text, ''), q.query, %(options)s) "
+               "FROM ranked "
+               "JOIN articles x ON x.article_id = ranked.article_id "
+               "CROSS JOIN q "
+               "ORDER BY ranked.rank DESC, x.article_id DESC")
+
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'search_page_prefix' if tail is not None else 'search_page',
+                                 {'head': head, 'tail': tail, 'status': status, 'limit': limit + 1, 'offset': offset,
+                                  'options': HEADLINE_OPTIONS}, sql=sql)
+            rows = cursor.fetchall()
+
+        next_offset = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_offset = offset + limit
+
+        return rows, next_offset
+
+    @replica_read
     def get_article(self, article_id):
-        self.cursor.execute("SELECT x.article_id, status, date_created, time_created, date_updated, time_updated, title, short_description, y.topics, thumbnail, content "
-                                "FROM articles x "
-                                "LEFT JOIN ( SELECT article_id, array_agg(topic) as topics "
-                                    "FROM topic_assignments "
-                                    "GROUP BY article_id) "
-                                    "AS y ON x.article_id = y.article_id "
-                                "WHERE x.article_id=%s ", (article_id,))
-        results = self.cursor.fetchone()
-        return results
+        """Returns a full article row. The thumbnail is served by its own endpoint so only its presence is fetched"""
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'article', (article_id,))
+            results = cursor.fetchone()
+            return results
 
+    @primary_read
     def check_article_exists(self, article_id):
-        self.cursor.execute("SELECT EXISTS(SELECT 1 "
-                            "FROM articles "
-                            "WHERE article_id = %s);", (article_id,))
-        result = self.cursor.fetchone()[0]
+        with self.transaction() as cursor:
+            cursor.execute("SELECT EXISTS(SELECT 1 "
+                           "FROM articles "
+                           "WHERE article_id = %s);", (article_id,))
+            result = cursor.fetchone()[0]
 
-        return result
+            return result
 
     def set_article_status(self, article_id, status):
-        self.cursor.execute("UPDATE articles "
-                            "SET status=%s "
-                            "WHERE article_id=%s;", (status, article_id))
-        self.con.commit()
+        with self.transaction() as cursor:
+            self._set_status(cursor, article_id, status)
 
     def delete_article(self, article_id):
-        self.cursor.execute("DELETE "
-                            "FROM topic_assignments "
-                            "WHERE article_id=%s;", (article_id, ))
-        self.con.commit()
+        with self.transaction() as cursor:
+            self._set_status(cursor, article_id, 'deleted')
 
-        self.cursor.execute("DELETE "
-                            "FROM articles "
-                            "WHERE article_id=%s;", (article_id, ))
-        self.con.commit()
-
-    def add_topics(self, article_id, topics):
-        # Get list of topics by article_id
-        self.cursor.execute("SELECT topic "
-                                  "FROM topic_assignments "
-                                  "WHERE article_id=%s", (article_id))
-
-        existing_topics = self.cursor.fetchall()
-        existing_topics = [x[0] for x in existing_topics]
-        topics = list(filter(None, [x.strip().lower().title() for x in topics]))
-
-        topic_list = []  # list of topics that are the same
-        arg_list = []  # list of topics to add
-        for topic in topics:
-            t = topic.strip().lower().title()
-
-            if topic not in existing_topics:
-                arg_list.append((article_id, t))
-            else:
-                topic_list.append(t)
-
-        if len(arg_list) > 0:
-            args = ','.join(self.cursor.mogrify("(%s, %s)", i).decode('utf-8')
-                            for i in arg_list)
-
-            self.cursor.execute("INSERT INTO topic_assignments(article_id, topic) "
-                                "VALUES " + args)
-            self.con.commit()
-
-        # create list of topics to delete
-        delete_list = [x for x in existing_topics if x not in topic_list]
-
-        # delete if we need to
-        if len(delete_list) > 0:
-            arg_topic_list = []
-
-            for delete_item in delete_list:
-                arg_topic_list.append((delete_item,))
-
-                args_t = ','.join(self.cursor.mogrify("%s", i).decode('utf-8')
-                                for i in arg_topic_list)
-
-            self.cursor.execute("DELETE FROM topic_assignments "
-                                "WHERE article_id=" + article_id + " AND topic IN (" + args_t + ")")
-            self.con.commit()
+            cursor.execute("DELETE "
+                           "FROM related_articles "
+                           "WHERE article_id=%s OR related_id=%s;", (article_id, article_id))
 
+            cursor.execute("DELETE "
+                           "FROM topic_assignments "
+                           "WHERE article_id=%s;", (article_id, ))
 
+            cursor.execute("DELETE "
+                           "FROM articles "
+                           "WHERE article_id=%s;", (article_id, ))
 
+    def add_topics(self, article_id, topics):
+        """Replaces the topics of an article with topics in a single statement. The assignments, the article's topic
+        array and the published counts are changed together, inside the caller's transaction"""
+        # normalize and drop duplicates while keeping the order the editor typed them in
+        topics = list(dict.fromkeys(filter(None, [x.strip().lower().title() for x in topics])))
+
+        with self.transaction() as cursor:
+            cursor.execute("WITH "
+                               "removed AS ( "
+                                   "DELETE FROM topic_assignments "
+                                   "WHERE article_id = %(article_id)s::int AND topic <> ALL(%(topics)s::varchar[]) "
+                                   "RETURNING topic), "
+                               "added AS ( "
+                                   "INSERT INTO topic_assignments(article_id, topic) "
+                                   "SELECT %(article_id)s::int, topic FROM unnest(%(topics)s::varchar[]) AS t(topic) "
+                                   "ON CONFLICT (article_id, topic) DO NOTHING "
+                                   "RETURNING topic), "
+                               "article AS ( "
+                                   "UPDATE articles "
+                                   "SET topics = %(topics)s::varchar[] "
+                                   "WHERE article_id = %(article_id)s::int "
+                                   "RETURNING status), "
+                               "counts AS ( "
+                                   "INSERT INTO topic_counts(topic, published_count) "
+                                   "SELECT topic, SUM(delta) "
+                                   "FROM (SELECT topic, 1 AS delta FROM added "
+                                         "UNION ALL "
+                                         "SELECT topic, -1 FROM removed) AS changes "
+                                   "WHERE (SELECT status FROM article) = 'publish' "
+                                   "GROUP BY topic "
+                                   "ON CONFLICT (topic) DO UPDATE "
+                                   "SET published_count = topic_counts.published_count + EXCLUDED.published_count) "
+                           "SELECT (SELECT status FROM article), "
+                                  "EXISTS(SELECT 1 FROM added), "
+                                  "ARRAY(SELECT topic FROM removed)",
+                           {'article_id': article_id, 'topics': topics})
+            row = cursor.fetchone()
+
+            # drafts are not anyone's neighbour, their list is built when they get published
+            if row is not None and row[0] == 'publish' and (row[1] or row[2]):
+                self._refresh_related_around(cursor, article_id)
+
+    @replica_read
     def get_topics(self,):
         """Returns a list of topics and their count"""
-        self.cursor.execute("SELECT topic, COUNT(topic) AS topic_count "
-                            "FROM topic_assignments "
-                            "LEFT JOIN articles ON articles.article_id = topic_assignments.article_id "
-                            "WHERE articles.status = 'publish' "
-                            "GROUP BY topic")
-        results = self.cursor.fetchall()
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'topics')
+            results = cursor.fetchall()
 
-        topic_list = []
-        for result in results:
-            topic_list.append([result[0], result[1]])
+            topic_list = []
+            for result in results:
+                topic_list.append([result[0], result[1]])
 
-        return topic_list
+            return topic_list
 
     def add_like(self, article_id, user_id):
-        """Adds a like to an article"""
-
-        date = datetime.today()
-        self.cursor.execute("INSERT INTO article_likes(date_liked, article_id, user_id) "
-                            "SELECT %s, %s, %s "
-                            "WHERE NOT EXISTS ("
-                                "SELECT article_id, user_id "
-                                "FROM article_likes "
-                                "WHERE article_id = %s AND user_id = %s) ", (date, article_id, user_id, article_id, user_id))
-        self.con.commit()
-
-        result = self.get_like_count(article_id, user_id)
+        """Adds a like to an article and returns (like count, liked) in one round trip, or None when there is no such
+        article"""
+        with self.transaction() as cursor:
+            date = datetime.today()
+            self.queries.execute(cursor, 'add_like', (date, user_id, article_id, article_id))
 
-        return result
+            return cursor.fetchone()
 
     def remove_like(self, article_id, user_id):
-        """Subtracts a like from an article"""
-        self.cursor.execute("DELETE "
-                            "FROM article_likes "
-                            "WHERE article_id = %s AND user_id = %s", (article_id, user_id))
-        self.con.commit()
-
-        result = self.get_like_count(article_id, user_id)
-
-        return result
-
+        """Subtracts a like from an article and returns (like count, liked) in one round trip, or None when there is
+        no such article"""
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'remove_like', (article_id, user_id, article_id))
+
+            return cursor.fetchone()
+
+    def apply_likes(self, likes, unlikes):
+        """Bulk version of add_like/remove_like for lists of (article_id, user_id) pairs. The like counters are moved
+        by the number of rows that actually changed"""
+        with self.transaction() as cursor:
+            date = datetime.today()
+            changes = []
+
+            if likes:
+                # likes of articles deleted since the click are dropped rather than failing the batch
+                changes += execute_values(cursor,
+                                          "INSERT INTO article_likes(date_liked, article_id, user_id) "
+                                          "SELECT v.date_liked, v.article_id, v.user_id "
+                                          "FROM (VALUES %s) AS v(date_liked, article_id, user_id) "
+                                          "JOIN articles a ON a.article_id = v.article_id "
+                                          "ON CONFLICT (article_id, user_id) DO NOTHING "
+                                          "RETURNING article_id, 1",
+                                          [(date, article_id, user_id) for article_id, user_id in likes],
+                                          fetch=True)
+            if unlikes:
+                changes += execute_values(cursor,
+                                          "DELETE "
+                                          "FROM article_likes AS l "
+                                          "USING (VALUES %s) AS v(article_id, user_id) "
+                                          "WHERE l.article_id = v.article_id AND l.user_id = v.user_id "
+                                          "RETURNING l.article_id, -1",
+                                          unlikes, fetch=True)
+
+            deltas = Counter()
+            for article_id, delta in changes:
+                deltas[article_id] += delta
+
+            # a fixed order keeps concurrent flushes from deadlocking on the article rows
+            deltas = sorted((article_id, delta) for article_id, delta in deltas.items() if delta)
+            if deltas:
+                execute_values(cursor,
+                               "UPDATE articles "
+                               "SET like_count = like_count + v.delta "
+                               "FROM (VALUES %s) AS v(article_id, delta) "
+                               "WHERE articles.article_id = v.article_id",
+                               deltas)
+
+    @replica_read
+    def get_like_state(self, article_id, user_id=None):
+        """Returns (like count, liked) like get_like_count, or None when there is no such article"""
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'like_count', (article_id, user_id, article_id))
+
+            return cursor.fetchone()
+
+    @replica_read
     def get_like_count(self, article_id, user_id=None):
         """Returns the count of  likes for specified article and if registered user is viewing return if user liked
         article"""
-        self.cursor.execute("WITH "
-                                "user_liked(article_id, liked_by_user) "
-                            "AS ( "
-                                "SELECT article_id, EXISTS( "
-                                    "SELECT 1 "
-                                    "FROM article_likes "
-                                    "WHERE user_id = %s and article_id=%s ) "
-                                "FROM article_likes "
-                                "WHERE article_id=%s and user_id=%s) "
-                            "SELECT COUNT(al.article_id), ul.liked_by_user "
-                            "FROM article_likes AS al "
-                            "LEFT JOIN user_liked AS ul ON al.article_id = ul.article_id "
-                            "WHERE al.article_id = %s "
-                            "GROUP BY ul.liked_by_user ", (user_id, article_id, article_id, user_id, article_id))
-
-        result = self.cursor.fetchone()
-
-
-        if result == None:
-            result = (0, False)
-
-        return result
\ No newline at end of file
+        with self.transaction() as cursor:
+            self.queries.execute(cursor, 'like_count', (article_id, user_id, article_id))
+
+            result = cursor.fetchone()
+
+            if result == None:
+                result = (0, False)
+
+            return result
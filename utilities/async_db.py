@@ -0,0 +1,117 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+
+from .articles_db import (ARTICLE_QUERY, ARTICLE_VERSION_QUERY, LIKE_COUNT_QUERY, RELATED_ARTICLES_KEPT, RELATED_QUERY,
+                          TOPICS_QUERY, summary_page, summary_query)
+from .metrics import fetched_bytes
+from .pagination import DEFAULT_LIMIT
+
+try:
+    from psycopg_pool import AsyncConnectionPool
+except ImportError:  # only needed with ASYNC_DB=1
+    AsyncConnectionPool = None
+
+
+class AsyncArticleDb:
+    """The queries of the public read path on psycopg 3's asyncio driver.
+
+    Every method is a coroutine, so independent queries can be awaited together with asyncio.gather and run on
+    separate pooled connections at the same time. Flask runs each async view in an event loop of its own, so the pool
+    lives on a background loop that outlives them and queries are handed over to it.
+    """
+
+    def __init__(self, connection_string, min_size=1, max_size=10, timeout=30.0):
+        if AsyncConnectionPool is None:
+            raise RuntimeError('the psycopg[pool] package is required to use the async read path')
+
+        self.connection_string = connection_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        # called with (label, seconds, rows, bytes fetched, query) after every query, like ArticleDb.observers
+        self.observers = []
+
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pool = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # started lazily and per process so forked workers each get their own loop and connections
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return self._loop
+
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='async-db', daemon=True).start()
+            self._pool = asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+            self._loop, self._pid = loop, os.getpid()
+            return loop
+
+    async def _open(self):
+        pool = AsyncConnectionPool(self.connection_string, min_size=self.min_size, max_size=self.max_size,
+                                   timeout=self.timeout, open=False)
+        await pool.open()
+        return pool
+
+    async def _query(self, query, args=None, one=False):
+        async with self._pool.connection() as con:
+            async with con.cursor() as cursor:
+                await cursor.execute(query, args)
+                return await (cursor.fetchone() if one else cursor.fetchall())
+
+    async def fetch(self, label, query, args=None, one=False):
+        """Runs a query on the background loop and waits for its rows from the caller's loop"""
+        loop = self._ensure_started()
+        start = time.perf_counter()
+        result = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._query(query, args, one), loop))
+        elapsed = time.perf_counter() - start
+
+        rows = [result] if one and result is not None else ([] if one else result)
+        for observer in self.observers:
+            observer(label, elapsed, len(rows), fetched_bytes(rows), query)
+        return result
+
+    async def get_article(self, article_id):
+        return await self.fetch('article', ARTICLE_QUERY, (article_id,), one=True)
+
+    async def get_article_version(self, article_id):
+        return await self.fetch('article_version', ARTICLE_VERSION_QUERY, (article_id,), one=True)
+
+    async def get_related_article_summaries(self, article_id, count=5):
+        results = await self.fetch('related_articles', RELATED_QUERY, (article_id, RELATED_ARTICLES_KEPT))
+        return random.sample(results, min(count, len(results)))
+
+    async def get_like_count(self, article_id, user_id=None):
+        result = await self.fetch('like_count', LIKE_COUNT_QUERY, (article_id, user_id, article_id), one=True)
+        return result if result is not None else (0, False)
+
+    async def get_topics(self):
+        return [[topic, count] for topic, count in await self.fetch('topics', TOPICS_QUERY)]
+
+    async def get_article_summary_page(self, status, limit=DEFAULT_LIMIT, cursor=None, topic=None, search=None):
+        query, args = summary_query(status, cursor, topic, search)
+        return summary_page(await self.fetch('summary_page', query + "LIMIT %s", args + [limit + 1]), limit)
+
+    def close(self):
+        if self._loop is not None and self._pid == os.getpid():
+            asyncio.run_coroutine_threadsafe(self._pool.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+
+class BlockingReads:
+    """Awaitable wrapper around an object with blocking methods, such as ArticleDb or LikeBuffer. Lets the async views
+    run without psycopg 3, the queries then simply run one after another"""
+
+    def __init__(self, target):
+        self.target = target
+
+    def __getattr__(self, name):
+        # run on the thread that is serving the request, which holds its pinned connection
+        return sync_to_async(getattr(self.target, name), thread_sensitive=True)
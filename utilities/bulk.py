@@ -0,0 +1,213 @@
+import io
+import json
+import os
+
+# COPY in csv mode with a quote and delimiter that never appear in json, so every row goes over the wire as a plain
+# json document, one per line, and files are read back without parsing them in python
+COPY_OPTIONS = "WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')"
+
+
+class BulkTable:
+    """A table moved by export_content/import_content. Rows are paged in key order, the key must be unique"""
+
+    def __init__(self, name, key, columns, serial=None):
+        self.name = name
+        self.key = key
+        self.columns = columns
+        # column whose sequence is moved past the imported ids
+        self.serial = serial
+
+    @property
+    def file_name(self):
+        return self.name + '.ndjson'
+
+
+# in import order, rows only reference tables before them. Topic counts, related articles and the content version are
+# derived and rebuilt after an import
+TABLES = [
+    BulkTable('articles', ('article_id',),
+              ('article_id', 'status', 'date_created', 'time_created', 'date_updated', 'time_updated', 'title',
+               'short_description', 'topics', 'thumbnail', 'content', 'content_text', 'like_count')),
+    BulkTable('topic_assignments', ('article_id', 'topic'), ('article_id', 'topic')),
+    BulkTable('article_imgs', ('image_id',),
+              ('image_id', 'article_id', 'id_fn', 'file_name', 'image', 'date_uploaded', 'digest'), serial='image_id'),
+    BulkTable('image_blobs', ('digest', 'variant'),
+              ('digest', 'variant', 'mimetype', 'width', 'height', 'byte_size', 'data', 'date_created')),
+    BulkTable('article_likes', ('article_id', 'user_id'), ('date_liked', 'article_id', 'user_id')),
+]
+
+
+# tables whose new rows change related articles, and the table the like counters are computed from
+RELATED_TABLES = ('articles', 'topic_assignments')
+LIKES_TABLE = 'article_likes'
+
+
+class _RowWriter:
+    """File wrapper for COPY TO that remembers the last row written and how many there were"""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.rows = 0
+        self.last = None
+        self._partial = b''
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.fh.write(data)
+
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        if lines:
+            self.rows += len(lines)
+            self.last = lines[-1]
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_checkpoint(path, checkpoint):
+    # replaced in one step so an interrupted run never leaves half a checkpoint
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as fh:
+        json.dump(checkpoint, fh)
+    os.replace(temp_path, path)
+
+
+def export_content(db, directory, batch_size=1000, tables=TABLES, progress=None):
+    """Writes every row of tables to <directory>/<table>.ndjson with COPY, batch_size rows per statement. Progress is
+    checkpointed after each batch, so an interrupted export continues where it stopped when run again. Returns
+    {table: rows exported}"""
+    os.makedirs(directory, exist_ok=True)
+    checkpoint_path = os.path.join(directory, 'export-checkpoint.json')
+    checkpoint = _load_checkpoint(checkpoint_path)
+
+    for table in tables:
+        state = checkpoint.setdefault(table.name, {'last_key': None, 'size': 0, 'rows': 0, 'done': False})
+        if state['done']:
+            continue
+
+        path = os.path.join(directory, table.file_name)
+        key = ', '.join(table.key)
+        with open(path, 'ab') as fh:
+            # drop whatever was written after the last checkpoint
+            fh.truncate(state['size'])
+            while True:
+                with db.transaction() as cursor:
+                    query = ("SELECT " + ', '.join(table.columns) + " "
+                             "FROM " + table.name + " ")
+                    args = []
+                    if state['last_key'] is not None:
+                        query += "WHERE (" + key + ") > (" + ', '.join(['%s'] * len(table.key)) + ") "
+                        args = state['last_key']
+                    query += "ORDER BY " + key + " LIMIT %s"
+
+                    writer = _RowWriter(fh)
+                    cursor.copy_expert("COPY (SELECT row_to_json(t) FROM (" +
+                                       cursor.mogrify(query, args + [batch_size]).decode('utf-8') +
+                                       ") AS t) TO STDOUT " + COPY_OPTIONS, writer)
+
+                fh.flush()
+                if writer.rows:
+                    last = json.loads(writer.last)
+                    state['last_key'] = [last[column] for column in table.key]
+                    state['rows'] += writer.rows
+                state['size'] = fh.tell()
+                state['done'] = writer.rows < batch_size
+                _save_checkpoint(checkpoint_path, checkpoint)
+                if progress is not None:
+                    progress(table.name, state['rows'])
+                if state['done']:
+                    break
+
+    return {table.name: checkpoint[table.name]['rows'] for table in tables}
+
+
+def import_content(db, directory, batch_size=1000, tables=TABLES, checkpoint_path=None, progress=None):
+    """Loads the files written by export_content with COPY, one transaction per batch_size rows. Rows whose key
+    already exists are skipped, so imports can be repeated and run into a database that already has content. Progress
+    is checkpointed after each batch and an interrupted import continues where it stopped. The like counters of
+    articles that got likes are recounted, and the related articles of imported articles are refreshed. Returns
+    {table: rows read}"""
+    checkpoint_path = checkpoint_path or os.path.join(directory, 'import-checkpoint.json')
+    checkpoint = _load_checkpoint(checkpoint_path)
+    # ids of articles whose rows or topics were inserted, kept in the checkpoint until their related lists are done
+    related_ids = set(checkpoint.setdefault('related_ids', []))
+
+    for table in tables:
+        path = os.path.join(directory, table.file_name)
+        state = checkpoint.setdefault(table.name, {'offset': 0, 'rows': 0, 'done': False})
+        if state['done'] or not os.path.exists(path):
+            continue
+
+        columns = ', '.join(table.columns)
+        with open(path, 'rb') as fh:
+            fh.seek(state['offset'])
+            while True:
+                # only one batch is ever held in memory
+                batch = io.BytesIO()
+                rows = 0
+                for line in iter(fh.readline, b''):
+                    if line.strip():
+                        batch.write(line)
+                        rows += 1
+                        if rows == batch_size:
+                            break
+                batch.seek(0)
+
+                if rows:
+                    tracked = table.name in RELATED_TABLES or table.name == LIKES_TABLE
+                    with db.transaction() as cursor:
+                        cursor.execute("CREATE TEMP TABLE bulk_staging(doc jsonb) ON COMMIT DROP")
+                        cursor.copy_expert("COPY bulk_staging(doc) FROM STDIN " + COPY_OPTIONS, batch)
+                        cursor.execute("INSERT INTO " + table.name + "(" + columns + ") "
+                                       "SELECT " + ', '.join('r.' + column for column in table.columns) + " "
+                                       "FROM bulk_staging, jsonb_populate_record(NULL::" + table.name + ", doc) AS r "
+                                       "ON CONFLICT DO NOTHING" + (" RETURNING article_id" if tracked else ""))
+                        inserted = sorted({row[0] for row in cursor.fetchall()}) if tracked else []
+
+                        # an article that already existed kept its counter, it is recounted from the likes now there
+                        if table.name == LIKES_TABLE and inserted:
+                            cursor.execute("UPDATE articles x "
+                                           "SET like_count = (SELECT COUNT(*) "
+                                                             "FROM article_likes l "
+                                                             "WHERE l.article_id = x.article_id) "
+                                           "WHERE x.article_id = ANY(%s)", (inserted,))
+                    if table.name in RELATED_TABLES:
+                        related_ids.update(inserted)
+                        checkpoint['related_ids'] = sorted(related_ids)
+
+                state['offset'] = fh.tell()
+                state['rows'] += rows
+                state['done'] = rows < batch_size
+                _save_checkpoint(checkpoint_path, checkpoint)
+                if progress is not None:
+                    progress(table.name, state['rows'])
+                if state['done']:
+                    break
+
+        if table.serial is not None:
+            with db.transaction() as cursor:
+                cursor.execute("SELECT setval(pg_get_serial_sequence(%s, %s), "
+                               "greatest((SELECT max(" + table.serial + ") FROM " + table.name + "), 1))",
+                               (table.name, table.serial))
+
+    # the derived tables, from the rows that are now there. Only the imported articles move through related lists,
+    # one batch per transaction
+    db.rebuild_topic_store()
+    related_ids = sorted(related_ids)
+    for start in range(0, len(related_ids), batch_size):
+        with db.transaction() as cursor:
+            for article_id in related_ids[start:start + batch_size]:
+                db._refresh_related_around(cursor, article_id)
+    checkpoint['related_ids'] = []
+    _save_checkpoint(checkpoint_path, checkpoint)
+    with db.transaction() as cursor:
+        db._bump_content_version(cursor)
+
+    return {table.name: checkpoint[table.name]['rows'] for table in tables if table.name in checkpoint}
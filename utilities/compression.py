@@ -0,0 +1,108 @@
+import gzip
+import hashlib
+import zlib
+
+try:
+    import brotli
+except ImportError:  # without the brotli package responses are never brotli encoded
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # without the zstandard package responses are never zstd encoded
+    zstandard = None
+
+# in order of preference when a client accepts several equally
+ENCODINGS = ('br', 'zstd', 'gzip')
+
+COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/plain', 'text/javascript', 'text/xml', 'application/javascript',
+                      'application/json', 'application/xml', 'image/svg+xml'}
+
+# levels for bodies compressed on every request, and for stable bodies compressed once and cached
+FAST_LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6}
+BEST_LEVELS = {'br': 9, 'zstd': 12, 'gzip': 9}
+
+
+def available_encodings():
+    return [encoding for encoding in ENCODINGS
+            if encoding == 'gzip' or encoding == 'br' and brotli is not None or
+            encoding == 'zstd' and zstandard is not None]
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    # a fixed mtime keeps the output the same for the same body
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding, level):
+    """Compresses an iterable of byte chunks, flushing after each chunk so the client can render what was sent"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    elif encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        yield compressor.flush()
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+class ResponseCompressor:
+    """Compresses responses with the best encoding a client accepts among br, zstd and gzip.
+
+    Bodies smaller than min_bytes are sent as they are. Streamed responses are compressed chunk by chunk. Public
+    responses with an etag are stable, their encoded bytes are kept in cache under a digest of the identity bytes, so
+    repeated requests are not compressed again. An etag does not always identify the body, a listing's etag is the
+    content version, so it is not part of the key.
+    """
+
+    def __init__(self, min_bytes=1024, cache=None):
+        self.min_bytes = min_bytes
+        self.cache = cache
+        self.encodings = available_encodings()
+
+    def process(self, request, response):
+        if request.method == 'HEAD' or response.status_code != 200 or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.iter_encoded(), encoding, FAST_LEVELS[encoding])
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_bytes:
+                return response
+
+            etag, weak = response.get_etag()
+            if self.cache is not None and etag and response.cache_control.public:
+                key = '%s|%s' % (encoding, hashlib.blake2b(data, digest_size=16).hexdigest())
+                encoded = self.cache.get(key)
+                if encoded is None:
+                    encoded = compress(data, encoding, BEST_LEVELS[encoding])
+                    self.cache.set(key, encoded)
+            else:
+                encoded = compress(data, encoding, FAST_LEVELS[encoding])
+            response.set_data(encoded)
+
+        response.headers['Content-Encoding'] = encoding
+        # the encoded bytes differ from the identity ones, a weak etag still validates either with If-None-Match
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
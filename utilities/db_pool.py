@@ -0,0 +1,230 @@
+import logging
+import os
+import psycopg2
+import threading
+import time
+from collections import deque
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out of the pool in time"""
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of psycopg2 connections.
+
+    Connections are health checked when they are checked out and replaced if the server dropped them, so one broken
+    connection never leaks into later requests.
+    """
+
+    def __init__(self, connection_string, min_size=1, max_size=10, timeout=30.0, check_after=5.0):
+        if min_size > max_size:
+            raise ValueError('min_size can not be larger than max_size')
+
+        self.connection_string = connection_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        # connections idle for longer than this many seconds are pinged before being handed out
+        self.check_after = check_after
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (connection, time returned to the pool)
+        self._size = 0
+        self._in_use = 0
+
+        # statistics
+        self._started = time.monotonic()
+        self._checkout_times = deque()  # monotonic timestamps of checkouts in the last minute
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._reconnects = 0
+
+        # nothing is opened here, so importing the app and forking workers never waits on the database. The first
+        # checkout in a process opens its connection and tops the pool up to min_size in the background
+        self._prefilled_pid = None
+
+    def prefill(self):
+        """Opens connections until the pool holds min_size of them"""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                con = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((con, time.monotonic()))
+                self._cond.notify()
+
+    def _connect(self):
+        return psycopg2.connect(self.connection_string)
+
+    def _healthy(self, con, idle_since):
+        """Returns False if the connection can not be used anymore"""
+        if con.closed:
+            return False
+
+        if con.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                con.rollback()
+            except psycopg2.Error:
+                return False
+
+        if time.monotonic() - idle_since >= self.check_after:
+            try:
+                with con.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                con.rollback()
+            except psycopg2.Error:
+                return False
+
+        return True
+
+    def getconn(self, timeout=None):
+        """Checks a connection out of the pool, waiting up to timeout seconds for one to become free"""
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout('no database connection available after %.1f seconds' % timeout)
+                waited = True
+                self._cond.wait(remaining)
+
+            if self._idle:
+                con, idle_since = self._idle.pop()
+            else:
+                con, idle_since = None, None
+                self._size += 1
+
+            self._in_use += 1
+            self._record_checkout(start, waited)
+
+        try:
+            if con is None:
+                con = self._connect()
+            elif not self._healthy(con, idle_since):
+                self._close(con)
+                con = self._connect()
+                with self._cond:
+                    self._reconnects += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        if self._prefilled_pid != os.getpid():
+            self._start_prefill()
+        return con
+
+    def _start_prefill(self):
+        with self._cond:
+            if self._prefilled_pid == os.getpid():
+                return
+            self._prefilled_pid = os.getpid()
+        if self.min_size > 1:
+            threading.Thread(target=self._prefill_quietly, name='pool-prefill', daemon=True).start()
+
+    def _prefill_quietly(self):
+        try:
+            self.prefill()
+        except Exception:
+            # the connections are opened on demand instead
+            logger.warning('opening %d pooled connections ahead of traffic failed', self.min_size, exc_info=True)
+
+    def putconn(self, con, broken=False):
+        """Returns a connection to the pool. Broken connections are closed and replaced on the next checkout"""
+        if not broken and not con.closed:
+            if con.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    con.rollback()
+                except psycopg2.Error:
+                    broken = True
+        else:
+            broken = True
+
+        with self._cond:
+            self._in_use -= 1
+            if broken or self._size > self.max_size:
+                self._size -= 1
+            else:
+                self._idle.append((con, time.monotonic()))
+                con = None
+            self._cond.notify()
+
+        if con is not None:
+            self._close(con)
+
+    def closeall(self):
+        """Closes every idle connection. Connections that are checked out are closed when they are returned"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self.max_size = 0
+
+        for con, _ in idle:
+            self._close(con)
+
+    def _close(self, con):
+        try:
+            con.close()
+        except psycopg2.Error:
+            pass
+
+    def _record_checkout(self, start, waited):
+        """Updates the checkout statistics. Must be called while holding the pool lock"""
+        now = time.monotonic()
+        wait = now - start
+
+        self._checkouts += 1
+        self._checkout_times.append(now)
+        while self._checkout_times and now - self._checkout_times[0] > 60:
+            self._checkout_times.popleft()
+
+        if waited:
+            self._waits += 1
+        self._wait_time += wait
+        self._max_wait = max(self._max_wait, wait)
+
+    def stats(self):
+        """Returns a snapshot of the pool usage that can be used to size the pool against the worker count"""
+        with self._cond:
+            now = time.monotonic()
+            while self._checkout_times and now - self._checkout_times[0] > 60:
+                self._checkout_times.popleft()
+            window = max(1.0, min(60.0, now - self._started))
+
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'checkouts': self._checkouts,
+                'checkouts_per_second': round(len(self._checkout_times) / window, 3),
+                'waits': self._waits,
+                'wait_time_total': round(self._wait_time, 6),
+                'wait_time_avg': round(self._wait_time / self._checkouts, 6) if self._checkouts else 0.0,
+                'wait_time_max': round(self._max_wait, 6),
+                'timeouts': self._timeouts,
+                'reconnects': self._reconnects,
+            }
@@ -0,0 +1,266 @@
+import hashlib
+import io
+import os
+import re
+import shutil
+import tempfile
+
+from .images import UnsupportedImage, image_mimetype, lazy_images
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # without Pillow only the original upload is stored and served for every variant
+    Image = None
+
+# maximum width of each generated variant, all variants are encoded as webp
+VARIANTS = {
+    'card': 480,
+    'inline': 1024,
+    'full': 2048,
+}
+
+CHUNK_SIZE = 64 * 1024
+
+# inline images never get wider than the article column
+INLINE_SIZES = '(max-width: 1024px) 100vw, 1024px'
+
+STORED_SRC_RE = re.compile(r'^/blog/images/([0-9a-f]{64})/')
+# the jinja tag older versions put in bodies, and the upload folder the editor pointed at before that
+LEGACY_SRC_RE = re.compile(r'''\{\{\s*image\[['"](.+?)['"]\]\s*\}\}|^/static/uploads/(.+)$''')
+
+
+class ImageStore:
+    """Content addressed image store.
+
+    Uploads are keyed by the sha256 of their bytes, so the same file uploaded to several articles is stored once.
+    Resized webp variants are generated when an image is first stored. Metadata always lives in the image_blobs table,
+    subclasses decide where the bytes go.
+    """
+
+    def __init__(self, db, variants=None, quality=80, max_bytes=20 * 1024 * 1024):
+        self.db = db
+        self.variants = VARIANTS if variants is None else variants
+        self.quality = quality
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def url(digest, variant='inline'):
+        return '/blog/images/%s/%s' % (digest, variant)
+
+    def put(self, stream):
+        """Stores an upload read from a file like object and returns its digest. Raises ValueError when the upload is
+        larger than max_bytes and UnsupportedImage when it is not a jpeg, png, gif or webp image"""
+        # spooled so small uploads stay in memory and large ones never do
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+            digest = hashlib.sha256()
+            size = 0
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ValueError('image is larger than %s bytes' % self.max_bytes)
+                digest.update(chunk)
+                spool.write(chunk)
+            digest = digest.hexdigest()
+
+            spool.seek(0)
+            mimetype = image_mimetype(spool.read(16), default=None)
+            if mimetype is None:
+                raise UnsupportedImage('only jpeg, png, gif and webp images are accepted')
+
+            if any(variant[0] == 'original' for variant in self.db.get_image_variants(digest)):
+                return digest
+
+            for variant, width in self.variants.items():
+                spool.seek(0)
+                resized = self.resize(spool, width)
+                if resized is not None:
+                    data, dimensions = resized
+                    self._store(digest, variant, 'image/webp', dimensions, len(data), io.BytesIO(data))
+
+            # the original goes last, once it exists the upload counts as stored
+            spool.seek(0)
+            dimensions = self._dimensions(spool)
+            spool.seek(0)
+            self._store(digest, 'original', mimetype, dimensions, size, spool)
+
+        return digest
+
+    def get(self, digest, variant):
+        """Returns (mimetype, date_created, data) of a variant, the original when the variant was never generated, or
+        None for an unknown digest"""
+        blob = self.db.get_image_blob(digest, variant)
+        if blob is None:
+            return None
+
+        stored_variant, mimetype, date_created, data = blob
+        if data is None:
+            data = self._read(digest, stored_variant)
+            if data is None:
+                return None
+        return mimetype, date_created, data
+
+    def image_attributes(self, digest, variant='inline'):
+        """Returns the src, srcset and intrinsic size attributes for an image tag showing a stored image"""
+        variants = {row[0]: row for row in self.db.get_image_variants(digest)}
+        attributes = {'src': self.url(digest, variant)}
+
+        # one candidate per distinct width, small images have the same width in every variant
+        candidates = {}
+        for name in self.variants:
+            if name in variants and variants[name][2]:
+                candidates.setdefault(variants[name][2], self.url(digest, name))
+        if len(candidates) > 1:
+            attributes['srcset'] = ', '.join('%s %sw' % (url, width) for width, url in sorted(candidates.items()))
+            attributes['sizes'] = INLINE_SIZES
+
+        shown = variants.get(variant) or variants.get('original')
+        if shown is not None and shown[2] and shown[3]:
+            attributes['width'], attributes['height'] = shown[2], shown[3]
+        return attributes
+
+    def article_body(self, content, digests):
+        """Rewrites the images of an article body to lazily loaded references into the store. digests maps the file
+        names of the article's uploads to their digest"""
+        def attributes_for(src):
+            match = STORED_SRC_RE.match(src)
+            if match is not None:
+                return self.image_attributes(match.group(1))
+
+            match = LEGACY_SRC_RE.search(src)
+            if match is not None:
+                digest = digests.get(match.group(1) or match.group(2))
+                if digest is not None:
+                    return self.image_attributes(digest)
+            return None
+
+        return lazy_images(content, attributes_for)
+
+    def resize(self, fileobj, width):
+        """Returns (webp bytes, (width, height)) of the image scaled down to at most width, or None when Pillow is
+        missing or cannot decode it"""
+        if Image is None:
+            return None
+
+        try:
+            with Image.open(fileobj) as image:
+                # camera images are often stored sideways with an orientation tag
+                image = ImageOps.exif_transpose(image)
+                if image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+                if image.width > width:
+                    image.thumbnail((width, width * 10))
+
+                output = io.BytesIO()
+                image.save(output, 'WEBP', quality=self.quality, method=4)
+                return output.getvalue(), image.size
+        except Exception:
+            return None
+
+    @staticmethod
+    def _dimensions(fileobj):
+        if Image is None:
+            return None
+        try:
+            with Image.open(fileobj) as image:
+                return ImageOps.exif_transpose(image).size
+        except Exception:
+            return None
+
+    def _store(self, digest, variant, mimetype, dimensions, size, fileobj):
+        raise NotImplementedError
+
+    def _read(self, digest, variant):
+        raise NotImplementedError
+
+
+class DbImageStore(ImageStore):
+    """Keeps image bytes in the image_blobs table next to their metadata"""
+
+    def _store(self, digest, variant, mimetype, dimensions, size, fileobj):
+        width, height = dimensions or (None, None)
+        self.db.add_image_blob(digest, variant, mimetype, width, height, size, fileobj.read())
+
+    def _read(self, digest, variant):
+        return None
+
+
+class FileImageStore(ImageStore):
+    """Keeps image bytes in files under root, sharded by the first two characters of the digest"""
+
+    def __init__(self, db, root, **kwargs):
+        super().__init__(db, **kwargs)
+        self.root = root
+
+    def path(self, digest, variant):
+        return os.path.join(self.root, digest[:2], '%s-%s' % (digest, variant))
+
+    def _store(self, digest, variant, mimetype, dimensions, size, fileobj):
+        path = self.path(digest, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # written under a temporary name so readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                shutil.copyfileobj(fileobj, fh, CHUNK_SIZE)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        width, height = dimensions or (None, None)
+        self.db.add_image_blob(digest, variant, mimetype, width, height, size, None)
+
+    def _read(self, digest, variant):
+        try:
+            with open(self.path(digest, variant), 'rb') as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+
+def image_store_from_url(url, db, **kwargs):
+    """Returns the image store for url: db:// keeps images in postgres, file:///path in a directory"""
+    if url.startswith('db://'):
+        return DbImageStore(db, **kwargs)
+    if url.startswith('file://'):
+        return FileImageStore(db, url[len('file://'):], **kwargs)
+
+    raise ValueError('unsupported image store url %r' % url)
+
+
+def migrate_article_images(db, store, batch_size=50):
+    """One-off migration that copies images stored in article_imgs into the store and rewrites every article body to
+    reference them by url instead of inlining base64 data. Returns (imported images, rewritten articles)"""
+    imported = 0
+    last_id = -1
+    while True:
+        rows = db.get_unstored_article_images(last_id, batch_size)
+        for image_id, data in rows:
+            try:
+                digest = store.put(io.BytesIO(bytes(data)))
+            except UnsupportedImage:
+                # such as an svg from before they were refused, it stays where it is and is served as a download
+                continue
+            db.set_article_image_digest(image_id, digest)
+            imported += 1
+        if len(rows) < batch_size:
+            break
+        last_id = rows[-1][0]
+
+    rewritten = 0
+    last_id = -1
+    while True:
+        rows = db.get_article_contents(last_id, batch_size)
+        for article_id, content in rows:
+            if content is None:
+                continue
+            updated = store.article_body(content, db.get_article_image_digests(article_id))
+            if updated != content:
+                db.set_article_content(article_id, updated)
+                rewritten += 1
+        if len(rows) < batch_size:
+            break
+        last_id = rows[-1][0]
+
+    return imported, rewritten
@@ -0,0 +1,77 @@
+import base64
+import binascii
+import html
+import re
+
+# leading bytes of the image formats the editor accepts. SVG is not one of them, an svg can carry script that would
+# run in the blog's origin
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+IMAGE_MIMETYPES = {mimetype for signature, mimetype in SIGNATURES} | {'image/webp'}
+
+BASE64_RE = re.compile(rb'^[A-Za-z0-9+/=\s]+$')
+
+# a quoted attribute value may hold a '>', the tag only ends outside of one
+IMG_TAG_RE = re.compile(r'''<img\b((?:[^>"']|"[^"]*"|'[^']*')*)>''', re.IGNORECASE)
+# the slash of a self-closing tag, not the last character of an unquoted value such as src=/img/
+SELF_CLOSING_RE = re.compile(r'''(^|[\s"'])/\s*$''')
+ATTRIBUTE_RE = re.compile(r'''([a-zA-Z][\w:-]*)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+))?''')
+
+
+class UnsupportedImage(ValueError):
+    """Raised for an upload that is not one of the accepted image formats"""
+
+
+def image_mimetype(data, default='image/jpeg'):
+    """Guesses the mimetype of raw image bytes from their signature"""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+
+    for signature, mimetype in SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+
+    return default
+
+
+def decode_legacy_base64(data):
+    """Returns the raw bytes of an image that was stored base64 encoded, or None if data is not base64 text"""
+    data = bytes(data)
+    if not BASE64_RE.match(data):
+        return None
+
+    try:
+        return base64.b64decode(b''.join(data.split()), validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def lazy_images(content, attributes_for):
+    """Rewrites every <img> tag in an article body to load lazily. attributes_for(src) returns the attributes that
+    replace the image's src (src, srcset, sizes, width, height), or None to keep its src as it is. Sizes set in the
+    editor are kept"""
+    def rewrite(match):
+        # attribute values are kept as written, only the replaced ones are escaped
+        attributes = {}
+        for name, value in ATTRIBUTE_RE.findall(SELF_CLOSING_RE.sub(r'\1', match.group(1))):
+            attributes[name.lower()] = value
+
+        src = attributes.get('src', '').strip('"\'')
+        replacement = attributes_for(html.unescape(src)) or {}
+        sized = 'width' in attributes or 'height' in attributes
+        for name, value in replacement.items():
+            if name in ('width', 'height') and sized:
+                continue
+            if value is not None:
+                attributes[name] = '"%s"' % html.escape(str(value))
+
+        attributes.setdefault('loading', '"lazy"')
+        attributes.setdefault('decoding', '"async"')
+        return '<img ' + ' '.join(name + '=' + value if value else name for name, value in attributes.items()) + '>'
+
+    return IMG_TAG_RE.sub(rewrite, content)
@@ -0,0 +1,192 @@
+import atexit
+import logging
+import os
+import threading
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# errors caused by the rows of a batch rather than by the database being unavailable
+ROW_ERRORS = (psycopg2.IntegrityError, psycopg2.DataError)
+
+
+class LikeBuffer:
+    """Write-behind buffer for likes.
+
+    Like and unlike clicks are coalesced in memory per (article_id, user_id) and written with one bulk statement per
+    flush, either when max_pending keys are waiting or every flush_interval seconds. Reads add the pending changes to
+    the persisted count so a user sees their click immediately. Exposes the same add_like, remove_like and
+    get_like_count methods as ArticleDb, add_like and remove_like return None for an article that does not exist.
+    Rows the database refuses are dropped, a batch that fails because the database is unavailable is retried.
+    """
+
+    def __init__(self, db, max_pending=500, flush_interval=1.0):
+        self.db = db
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # (article_id, user_id) -> [persisted liked, wanted liked]
+        self._flushing = {}  # the batch currently being written
+        self._deltas = {}  # article_id -> like count change not yet persisted
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+        self.flushes = 0
+        self.flushed_keys = 0
+        self.failures = 0
+        self.rejected = 0
+
+        atexit.register(self.close)
+
+    def add_like(self, article_id, user_id):
+        return self._record(article_id, user_id, True)
+
+    def remove_like(self, article_id, user_id):
+        return self._record(article_id, user_id, False)
+
+    def get_like_count(self, article_id, user_id=None):
+        count, liked = self.db.get_like_count(article_id, user_id)
+
+        with self._lock:
+            key = (int(article_id), int(user_id)) if user_id is not None else None
+            entry = self._pending.get(key) or self._flushing.get(key)
+            if entry is not None:
+                liked = entry[1]
+            return count + self._deltas.get(int(article_id), 0), liked
+
+    def _record(self, article_id, user_id, liked):
+        self._ensure_started()
+        key = (int(article_id), int(user_id))
+        state = self.db.get_like_state(*key)
+        if state is None:
+            return None
+        count, persisted = state
+
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                # a batch being written already decided this key, build on top of it
+                flushing = self._flushing.get(key)
+                base = flushing[1] if flushing is not None else persisted
+                entry = self._pending[key] = [base, base]
+
+            change = int(liked) - int(entry[1])
+            entry[1] = liked
+            if change:
+                self._deltas[key[0]] = self._deltas.get(key[0], 0) + change
+
+            full = len(self._pending) >= self.max_pending
+            count += self._deltas.get(key[0], 0)
+
+        if full:
+            self._wake.set()
+
+        return count, liked
+
+    def flush(self):
+        """Writes every pending change to the database. Safe to call from any thread"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+                batch = self._flushing
+
+            # keys that were toggled back to where they started cost nothing
+            likes = sorted(key for key, (base, liked) in batch.items() if liked and not base)
+            unlikes = sorted(key for key, (base, liked) in batch.items() if base and not liked)
+
+            try:
+                rejected = self._apply(likes, unlikes)
+            except Exception:
+                with self._lock:
+                    # put the batch back so the next flush retries it
+                    for key, entry in batch.items():
+                        newer = self._pending.get(key)
+                        if newer is None:
+                            self._pending[key] = entry
+                        else:
+                            newer[0] = entry[0]
+                    self._flushing = {}
+                    self.failures += 1
+                raise
+
+            with self._lock:
+                for key, (base, liked) in batch.items():
+                    change = int(liked) - int(base)
+                    if change:
+                        remaining = self._deltas.get(key[0], 0) - change
+                        if remaining:
+                            self._deltas[key[0]] = remaining
+                        else:
+                            self._deltas.pop(key[0], None)
+                for key in rejected:
+                    # a click since the flush started built on the dropped change, it starts from the database again
+                    newer = self._pending.get(key)
+                    if newer is not None:
+                        newer[0] = batch[key][0]
+                self._flushing = {}
+                self.flushes += 1
+                self.flushed_keys += len(likes) + len(unlikes) - len(rejected)
+                self.rejected += len(rejected)
+
+    def _apply(self, likes, unlikes):
+        """Writes a batch and returns the keys the database refused. One bad row fails the whole statement, so the
+        batch is then written a row at a time and only the rows that fail are dropped"""
+        try:
+            self.db.apply_likes(likes, unlikes)
+            return []
+        except ROW_ERRORS as error:
+            logger.warning('writing %d buffered likes failed, retrying them one at a time: %s',
+                           len(likes) + len(unlikes), str(error).strip())
+
+        rejected = []
+        for batch in [([key], []) for key in likes] + [([], [key]) for key in unlikes]:
+            try:
+                self.db.apply_likes(*batch)
+            except ROW_ERRORS as error:
+                key = (batch[0] or batch[1])[0]
+                logger.warning('dropped buffered like of article %d by user %d: %s', key[0], key[1],
+                               str(error).strip())
+                rejected.append(key)
+        return rejected
+
+    def _ensure_started(self):
+        # started lazily and per process so forked workers each get their own flush thread
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='like-buffer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('flushing buffered likes failed')
+
+    def close(self):
+        """Stops the flush thread and writes whatever is still pending"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending), 'flushing': len(self._flushing), 'flushes': self.flushes,
+                    'flushed_keys': self.flushed_keys, 'failures': self.failures, 'rejected': self.rejected}
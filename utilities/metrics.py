@@ -0,0 +1,229 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STATEMENT_VERB_RE = re.compile(r'^\s*(\w+)')
+STATEMENT_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)', re.IGNORECASE)
+
+# timings of the request being served, read back into its Server-Timing header
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+def statement_label(query):
+    """Short name of an ad hoc statement, such as 'select articles'. Prepared statements are named after their query"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = str(query)
+
+    verb = STATEMENT_VERB_RE.match(query)
+    verb = verb.group(1).lower() if verb else 'query'
+    if verb in ('execute', 'prepare'):
+        name = query.split()[1].split('(')[0]
+        return name if verb == 'execute' else 'prepare ' + name
+
+    table = STATEMENT_TABLE_RE.search(query)
+    return verb + ' ' + table.group(1) if table else verb
+
+
+def fetched_bytes(rows):
+    """Approximate size of fetched rows, counting text and binary values"""
+    size = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (str, bytes, memoryview)):
+                size += len(value)
+            elif value is not None:
+                size += 8
+    return size
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Cursor that reports each statement with its duration, rows and bytes fetched once the next one starts or the
+    cursor is closed. Time spent fetching counts towards the statement, for a server-side cursor that is where the
+    query runs"""
+
+    observers = ()
+    label = None
+
+    def execute(self, query, vars=None):
+        self._report()
+        self._statement = [self.label or statement_label(query), query, 0, 0, 0.0]
+        self.label = None
+
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._statement[4] = time.perf_counter() - start
+
+    def _count(self, rows, start):
+        statement = getattr(self, '_statement', None)
+        if statement is not None:
+            statement[2] += len(rows)
+            statement[3] += fetched_bytes(rows)
+            statement[4] += time.perf_counter() - start
+        return rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._count([row] if row is not None else [], start)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        return self._count(super().fetchmany(self.arraysize if size is None else size), start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        return self._count(super().fetchall(), start)
+
+    def close(self):
+        self._report()
+        super().close()
+
+    def _report(self):
+        statement = getattr(self, '_statement', None)
+        self._statement = None
+        if statement is not None:
+            label, query, rows, size, seconds = statement
+            for observer in self.observers:
+                observer(label, seconds, rows, size, query)
+
+
+class Histogram:
+    """Prometheus style histogram of one labelled series"""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """Collects database, template and request timings, renders them in the Prometheus text format and keeps the
+    timings of the current request for its Server-Timing header. Statements slower than slow_query_ms are logged"""
+
+    def __init__(self, prefix='blog', slow_query_ms=None):
+        self.prefix = prefix
+        self.slow_query_ms = slow_query_ms
+
+        self._lock = threading.Lock()
+        self._histograms = {}  # (metric, labels) -> Histogram
+        self._counters = {}  # (metric, labels) -> value
+        self._gauges = []  # callables returning {(metric, labels): value}
+
+    def observe(self, metric, labels, seconds):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, metric, labels, value=1):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauges(self, collect):
+        """Registers a callable returning {(metric, labels dict items tuple): value}, read on every scrape"""
+        self._gauges.append(collect)
+
+    def start_request(self):
+        """Starts collecting the Server-Timing entries of the request served in this context"""
+        current_timings.set([])
+
+    def end_request(self):
+        current_timings.set(None)
+
+    def record(self, category, seconds, description=None):
+        """Adds a timing to the Server-Timing header of the current request"""
+        timings = current_timings.get()
+        if timings is not None:
+            timings.append((category, seconds, description))
+
+    def query_observer(self, label, seconds, rows, size, query=None):
+        """Observer for InstrumentedCursor and AsyncArticleDb"""
+        self.observe('db_query_seconds', {'query': label}, seconds)
+        self.increment('db_rows_total', {'query': label}, rows)
+        self.increment('db_fetched_bytes_total', {'query': label}, size)
+        self.record('db', seconds)
+
+        if self.slow_query_ms is not None and seconds * 1000 >= self.slow_query_ms:
+            statement = query.decode('utf-8', 'replace') if isinstance(query, bytes) else str(query or '')
+            logger.warning('slow query %s took %.1f ms, %d rows, %d bytes: %s', label, seconds * 1000, rows, size,
+                           ' '.join(statement.split())[:500])
+
+    def server_timing(self, total):
+        """Builds the Server-Timing header value of the current request, timings of the same category are summed"""
+        durations = {}
+        counts = {}
+        for category, seconds, description in current_timings.get() or ():
+            durations[category] = durations.get(category, 0.0) + seconds
+            counts[category] = counts.get(category, 0) + 1
+
+        parts = ['%s;dur=%.2f;desc="%d"' % (category, durations[category] * 1000, counts[category])
+                 for category in durations]
+        parts.append('total;dur=%.2f' % (total * 1000))
+        return ', '.join(parts)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        gauges = []
+        for collect in self._gauges:
+            gauges.extend(sorted(collect().items()))
+
+        lines = []
+        typed = set()
+
+        def declare(metric, kind):
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s_%s %s' % (self.prefix, metric, kind))
+
+        for (metric, labels), histogram in histograms:
+            declare(metric, 'histogram')
+            for bound, count in zip(BUCKETS, histogram.counts):
+                lines.append('%s_%s_bucket%s %d' % (self.prefix, metric, format_labels(labels + (('le', bound),)),
+                                                    count))
+            lines.append('%s_%s_bucket%s %d' % (self.prefix, metric, format_labels(labels + (('le', '+Inf'),)),
+                                                histogram.count))
+            lines.append('%s_%s_sum%s %.6f' % (self.prefix, metric, format_labels(labels), histogram.sum))
+            lines.append('%s_%s_count%s %d' % (self.prefix, metric, format_labels(labels), histogram.count))
+
+        for (metric, labels), value in counters:
+            declare(metric, 'counter')
+            lines.append('%s_%s%s %s' % (self.prefix, metric, format_labels(labels), value))
+
+        for (metric, labels), value in gauges:
+            declare(metric, 'gauge')
+            lines.append('%s_%s%s %s' % (self.prefix, metric, format_labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join('%s="%s"' % (name, value) for (name, _), value in zip(labels, escaped)) + '}'
@@ -0,0 +1,66 @@
+from .articles_db import ArticleDb
+
+# held for the whole run so two deploys migrating at once apply every step exactly once, one after the other
+MIGRATION_LOCK_ID = 7233101
+
+# append only. A deployed version is never changed, later schema changes get the next number. The first steps are the
+# schema that used to be created on every boot, each of them adopts an existing database without changing it
+MIGRATIONS = [
+    (1, 'articles table', ArticleDb.create_article_table),
+    (2, 'weighted search vector and its gin index', ArticleDb.create_gin_index),
+    (3, 'article images table', ArticleDb.create_article_images_table),
+    (4, 'image store', ArticleDb.create_image_blobs_table),
+    (5, 'topic assignments', ArticleDb.create_topic_assignments_table),
+    (6, 'likes and like counts', ArticleDb.create_likes_table),
+    (7, 'listing indexes', ArticleDb.create_listing_indexes),
+    (8, 'denormalized topics and topic counts', ArticleDb.create_topic_store),
+    (9, 'related articles', ArticleDb.create_related_articles_table),
+    (10, 'content version', ArticleDb.create_content_version_table),
+]
+
+
+def schema_version(db):
+    """Returns the highest applied migration, 0 for a database that was never migrated"""
+    with db.transaction() as cursor:
+        cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return 0
+        cursor.execute("SELECT coalesce(max(version), 0) FROM schema_migrations")
+        return cursor.fetchone()[0]
+
+
+def migrate(db, target=None, migrations=MIGRATIONS):
+    """Applies the migrations newer than the database's schema version, up to target, and returns the versions it
+    applied. Each migration commits together with its schema_migrations row, so a failed one is retried on the next
+    run and the ones before it stay applied"""
+    applied = []
+    # every step runs on one connection, the one holding the session level advisory lock
+    db.checkout()
+    try:
+        with db.transaction() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            with db.transaction() as cursor:
+                cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations( "
+                               "version INT PRIMARY KEY, "
+                               "description TEXT NOT NULL, "
+                               "applied_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+                # read after taking the lock, a migrator that held it before us may have moved the version on
+                cursor.execute("SELECT version FROM schema_migrations")
+                done = {row[0] for row in cursor.fetchall()}
+
+            for version, description, step in sorted(migrations, key=lambda migration: migration[0]):
+                if version in done or (target is not None and version > target):
+                    continue
+                with db.transaction() as cursor:
+                    step(db)
+                    cursor.execute("INSERT INTO schema_migrations(version, description) "
+                                   "VALUES (%s, %s)", (version, description))
+                applied.append(version)
+        finally:
+            with db.transaction() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    finally:
+        db.release()
+
+    return applied
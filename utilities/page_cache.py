@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # only needed for the redis backend
+    redis = None
+
+
+class LRUCache:
+    """In-process cache of rendered strings with a maximum size and a time to live per entry"""
+
+    def __init__(self, max_entries=512, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, value)
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+class RedisCache:
+    """Cache backed by redis or any server speaking its protocol, shared by every worker process"""
+
+    def __init__(self, url, ttl=300, prefix='blog:'):
+        if redis is None:
+            raise RuntimeError('the redis package is required to use a redis:// page cache')
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value.decode('utf-8')
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value.encode('utf-8'), ex=self.ttl if ttl is None else ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+    def stats(self):
+        return {'backend': 'redis', 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+def page_cache_from_url(url, ttl=300, max_entries=512):
+    """Returns the cache backend for url: memory:// for an in-process LRU, redis:// or rediss:// for a shared server"""
+    if url.startswith('redis://') or url.startswith('rediss://') or url.startswith('unix://'):
+        return RedisCache(url, ttl=ttl)
+    if url.startswith('memory://'):
+        return LRUCache(max_entries=max_entries, ttl=ttl)
+
+    raise ValueError('unsupported page cache url %r' % url)
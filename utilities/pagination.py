@@ -0,0 +1,33 @@
+import base64
+import binascii
+from datetime import date, time
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def encode_cursor(date_created, time_created, article_id):
+    """Builds the opaque cursor that points just past an article in newest-first order"""
+    key = '%s|%s|%s' % (date_created.isoformat(), time_created.isoformat(), article_id)
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns the (date_created, time_created, article_id) keyset encoded in cursor. Raises ValueError if the cursor
+    was not produced by encode_cursor"""
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        date_created, time_created, article_id = key.split('|')
+        return date.fromisoformat(date_created), time.fromisoformat(time_created), int(article_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('invalid cursor')
+
+
+def page_limit(limit, default=DEFAULT_LIMIT, maximum=MAX_LIMIT):
+    """Clamps a user supplied page size"""
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return default
+
+    return max(1, min(limit, maximum))
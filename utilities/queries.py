@@ -0,0 +1,119 @@
+import re
+import threading
+import time
+import weakref
+
+# psycopg2 placeholders, and the escaped percent sign that stays a plain one in a prepared statement
+PLACEHOLDER_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+class Query:
+    """A query declared once in the registry, with its server-side statement and call statistics"""
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+
+        # the prepared form numbers the placeholders, named ones keep one number however often they are used
+        self.params = []
+
+        def number(match):
+            if match.group(0) == '%%':
+                return '%'
+            key = match.group(1)
+            if key is None:
+                key = len(self.params)
+            if key not in self.params:
+                self.params.append(key)
+            return '$%d' % (self.params.index(key) + 1)
+
+        self.statement = PLACEHOLDER_RE.sub(number, sql)
+        self.execute_sql = 'EXECUTE ' + name
+        if self.params:
+            self.execute_sql += '(' + ', '.join(['%s'] * len(self.params)) + ')'
+
+        self.calls = 0
+        self.prepares = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def arguments(self, args):
+        """Orders the arguments of a call the way the prepared statement numbers them"""
+        if not self.params:
+            return None
+        if isinstance(args, dict):
+            return [args[name] for name in self.params]
+        return list(args)
+
+
+class QueryRegistry:
+    """Central place for the hot queries of ArticleDb.
+
+    Each query is declared once under a name. With prepare=True it is sent to the server with PREPARE the first time
+    a connection runs it and afterwards only EXECUTEd, so Postgres neither parses nor plans it again. Calls and their
+    latency are counted per query either way.
+    """
+
+    def __init__(self, prepare=True):
+        self.prepare = prepare
+
+        self._lock = threading.Lock()
+        self._queries = {}
+        self._prepared = weakref.WeakKeyDictionary()  # connection -> names prepared on it
+
+    def register(self, name, sql):
+        with self._lock:
+            query = self._queries.get(name)
+            if query is None:
+                query = self._queries[name] = Query(name, sql)
+            return query
+
+    def __contains__(self, name):
+        return name in self._queries
+
+    def execute(self, cursor, name, args=None, sql=None):
+        """Runs the query registered as name on cursor. Queries built at runtime pass their sql and are registered on
+        their first call, a name must always stand for the same sql"""
+        query = self._queries.get(name)
+        if query is None:
+            query = self.register(name, sql)
+
+        start = time.perf_counter()
+        if self.prepare:
+            with self._lock:
+                prepared = self._prepared.setdefault(cursor.connection, set())
+            if name not in prepared:
+                cursor.execute('PREPARE ' + name + ' AS ' + query.statement)
+                prepared.add(name)
+                query.prepares += 1
+            self._label(cursor, name)
+            cursor.execute(query.execute_sql, query.arguments(args))
+        else:
+            self._label(cursor, name)
+            cursor.execute(query.sql, args)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            query.calls += 1
+            query.total_time += elapsed
+            query.max_time = max(query.max_time, elapsed)
+
+    @staticmethod
+    def _label(cursor, name):
+        # instrumented cursors report the statement under the query's name
+        if hasattr(cursor, 'label'):
+            cursor.label = name
+
+    def forget(self, connection):
+        """Drops what is known to be prepared on a connection, call after its session was reset"""
+        with self._lock:
+            self._prepared.pop(connection, None)
+
+    def stats(self):
+        with self._lock:
+            return {query.name: {'calls': query.calls,
+                                 'prepares': query.prepares,
+                                 'total_ms': round(query.total_time * 1000, 3),
+                                 'mean_ms': round(query.total_time * 1000 / query.calls, 3) if query.calls else 0.0,
+                                 'max_ms': round(query.max_time * 1000, 3)}
+                    for query in sorted(self._queries.values(), key=lambda query: -query.total_time)}
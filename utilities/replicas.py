@@ -0,0 +1,118 @@
+import itertools
+import logging
+import threading
+import time
+
+import psycopg2
+
+from .db_pool import ConnectionPool, PoolTimeout
+
+logger = logging.getLogger(__name__)
+
+# errors that mean the replica itself is unusable, rather than the statement
+REPLICA_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+
+SELECTIONS = ('round_robin', 'least_busy')
+
+LAG_QUERY = ("SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+             "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END")
+
+
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.last_error = None
+        self.lag = None
+        self.checked_at = 0.0
+
+
+class ReplicaSet:
+    """Read replicas of the primary, each with a pool of its own.
+
+    choose() spreads reads round robin or to the replica with the fewest connections in use. A replica that cannot be
+    reached, or with max_lag set falls further behind the primary than that many seconds, is ejected for eject_seconds
+    and then tried again.
+    """
+
+    def __init__(self, connection_strings, selection='round_robin', eject_seconds=30.0, max_lag=None,
+                 check_interval=5.0, **pool_kwargs):
+        if selection not in SELECTIONS:
+            raise ValueError('replica selection must be one of %s' % ', '.join(SELECTIONS))
+
+        self.selection = selection
+        self.eject_seconds = eject_seconds
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.replicas = [Replica('replica%d' % number, ConnectionPool(connection_string, **pool_kwargs))
+                         for number, connection_string in enumerate(connection_strings)]
+
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+
+    def choose(self):
+        """Returns the replica the next read goes to, or None when every replica is ejected"""
+        now = time.monotonic()
+        available = [replica for replica in self.replicas if replica.ejected_until <= now]
+        if self.max_lag is not None:
+            available = [replica for replica in available if self._caught_up(replica, now)]
+        if not available:
+            return None
+
+        if self.selection == 'least_busy':
+            return min(available, key=lambda replica: replica.pool.stats()['in_use'])
+        return available[next(self._next) % len(available)]
+
+    def eject(self, replica, error):
+        with self._lock:
+            replica.ejected_until = time.monotonic() + self.eject_seconds
+            replica.ejections += 1
+            replica.last_error = str(error).strip()
+        logger.warning('ejected %s for %.0f seconds: %s', replica.name, self.eject_seconds, replica.last_error)
+
+    def _caught_up(self, replica, now):
+        # one thread measures the lag every check_interval seconds, the others go by the last measurement
+        with self._lock:
+            due = now - replica.checked_at >= self.check_interval
+            if due:
+                replica.checked_at = now
+        if due:
+            try:
+                con = replica.pool.getconn()
+            except REPLICA_ERRORS as error:
+                self.eject(replica, error)
+                return False
+            broken = False
+            try:
+                with con.cursor() as cursor:
+                    cursor.execute(LAG_QUERY)
+                    lag = cursor.fetchone()[0]
+                con.rollback()
+                # a server that is not in recovery has no replay position and is never behind
+                replica.lag = float(lag or 0)
+            except psycopg2.Error as error:
+                broken = True
+                self.eject(replica, error)
+                return False
+            finally:
+                replica.pool.putconn(con, broken=broken)
+
+            if replica.lag > self.max_lag:
+                self.eject(replica, 'replication lag of %.1f seconds' % replica.lag)
+                return False
+        return replica.lag is None or replica.lag <= self.max_lag
+
+    def stats(self):
+        now = time.monotonic()
+        return {replica.name: dict(replica.pool.stats(),
+                                   ejected=replica.ejected_until > now,
+                                   ejections=replica.ejections,
+                                   last_error=replica.last_error,
+                                   lag=replica.lag)
+                for replica in self.replicas}
+
+    def closeall(self):
+        for replica in self.replicas:
+            replica.pool.closeall()
@@ -0,0 +1,27 @@
+import re
+from markupsafe import Markup, escape
+
+# ts_headline wraps matches in these, they are swapped for <mark> after the snippet has been escaped
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+HEADLINE_OPTIONS = 'StartSel=%s, StopSel=%s, MaxWords=30, MinWords=12, MaxFragments=2' % (HIGHLIGHT_START,
+                                                                                          HIGHLIGHT_STOP)
+
+TRAILING_WORD = re.compile(r'[^\W_]+$')
+
+
+def split_prefix(search):
+    """Splits a search typed so far into (head, prefix). head is parsed with websearch_to_tsquery and prefix is the
+    word still being typed as a to_tsquery prefix term, or None when the search does not end inside a word"""
+    match = TRAILING_WORD.search(search)
+    if match is None or search[:match.start()].endswith(('-', '"')):
+        # negated or quoted words are left to websearch_to_tsquery
+        return search, None
+
+    return search[:match.start()], match.group(0) + ':*'
+
+
+def highlight(snippet):
+    """Escapes a ts_headline snippet and marks the matched words"""
+    snippet = str(escape(snippet or ''))
+    return Markup(snippet.replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>'))
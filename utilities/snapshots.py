@@ -0,0 +1,179 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# each page is stored as <path>/index.html, so a front proxy can serve the directory as is, with its headers next to it
+PAGE_FILE = 'index.html'
+HEADERS_FILE = 'index.json'
+
+
+def snapshot_etag(body):
+    return hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+class MemorySnapshots:
+    """Snapshots kept in the process, for a single worker or development"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def get(self, path):
+        """Returns (body, headers) of the snapshot of path, or None"""
+        with self._lock:
+            return self._pages.get(path)
+
+    def put(self, path, body, headers):
+        with self._lock:
+            self._pages[path] = (body, headers)
+
+    def delete(self, path):
+        with self._lock:
+            self._pages.pop(path, None)
+
+    def paths(self):
+        with self._lock:
+            return list(self._pages)
+
+
+class DirectorySnapshots:
+    """Snapshots written under root, shared by every worker on the host and servable by a front proxy"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def directory(self, path):
+        # the decoded path, as a proxy maps a request to a file
+        relative = path.strip('/')
+        if '\0' in relative or relative and any(part in ('', '.', '..') for part in relative.split('/')):
+            raise ValueError('invalid snapshot path %r' % path)
+        return os.path.join(self.root, relative) if relative else self.root
+
+    def get(self, path):
+        try:
+            directory = self.directory(path)
+            with open(os.path.join(directory, PAGE_FILE), 'rb') as fh:
+                body = fh.read()
+            with open(os.path.join(directory, HEADERS_FILE)) as fh:
+                headers = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        return body, headers
+
+    def put(self, path, body, headers):
+        directory = self.directory(path)
+        os.makedirs(directory, exist_ok=True)
+        # headers first, a reader that sees the new page always finds headers that are at most as old as it
+        self._write(os.path.join(directory, HEADERS_FILE), json.dumps(headers).encode('utf-8'))
+        self._write(os.path.join(directory, PAGE_FILE), body)
+
+    def delete(self, path):
+        directory = self.directory(path)
+        for name in (PAGE_FILE, HEADERS_FILE):
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+    def paths(self):
+        paths = []
+        for directory, _, files in os.walk(self.root):
+            if PAGE_FILE in files:
+                relative = os.path.relpath(directory, self.root)
+                paths.append('/' + relative.replace(os.sep, '/') if relative != '.' else '/')
+        return paths
+
+    @staticmethod
+    def _write(path, data):
+        # renamed into place so readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+def snapshot_store_from_url(url):
+    """Returns the snapshot store for url: memory:// keeps pages in the process, file:///path in a directory"""
+    if url.startswith('memory://'):
+        return MemorySnapshots()
+    if url.startswith('file://'):
+        return DirectorySnapshots(url[len('file://'):])
+
+    raise ValueError('unsupported snapshot store url %r' % url)
+
+
+class Prerenderer:
+    """Renders pages into a snapshot store on a pool of worker threads.
+
+    render(path) returns (html, headers) for a page, or None when the page should not have a snapshot, for example
+    an article that is no longer published. A page that fails to render loses its snapshot, so it is served
+    dynamically rather than stale.
+    """
+
+    def __init__(self, store, render, workers=4):
+        self.store = store
+        self.render = render
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prerender')
+        self._lock = threading.Lock()
+        self._filled_pid = None
+
+    def render_path(self, path):
+        """Renders one page into the store and returns whether it has a snapshot now"""
+        try:
+            page = self.render(path)
+        except Exception:
+            logger.exception('pre-rendering %s failed', path)
+            page = None
+
+        if page is None:
+            self.store.delete(path)
+            return False
+
+        html, headers = page
+        body = html.encode('utf-8')
+        self.store.put(path, body, dict(headers, ETag=snapshot_etag(body)))
+        return True
+
+    def build(self, paths, prune=True):
+        """Renders every page in paths in parallel and waits for them. With prune the snapshots of other pages are
+        removed. Returns the number of snapshots written"""
+        paths = list(dict.fromkeys(paths))
+        rendered = sum(self._executor.map(self.render_path, paths))
+        if prune:
+            for stale in set(self.store.paths()) - set(paths):
+                self.store.delete(stale)
+        return rendered
+
+    def refresh(self, paths_of):
+        """Re-renders pages in the background. paths_of() runs on a worker and returns the paths to render, so
+        finding the affected pages does not hold up the caller either"""
+        def find_and_render():
+            for path in dict.fromkeys(paths_of()):
+                self._executor.submit(self.render_path, path)
+
+        future = self._executor.submit(find_and_render)
+        future.add_done_callback(lambda done: done.exception() and logger.error(
+            'finding pages to pre-render failed', exc_info=done.exception()))
+        return future
+
+    def fill_once(self, paths_of):
+        """Renders every page of paths_of() in the background the first time it is called in a process. A memory
+        store starts out empty in every worker and nothing else can fill it"""
+        with self._lock:
+            if self._filled_pid == os.getpid():
+                return None
+            self._filled_pid = os.getpid()
+        return self.refresh(paths_of)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,86 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from jinja2 import Environment, BaseLoader
+
+
+class TemplateCache:
+    """LRU cache of compiled article bodies.
+
+    Entries are keyed by article id and a hash of the stored source, so an edited article is recompiled even if nobody
+    invalidated it. Both the number of entries and the total size of the cached sources can be limited.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024, environment=None):
+        # one environment shared by every article instead of a new one per request
+        self.environment = environment or Environment(loader=BaseLoader())
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._templates = OrderedDict()  # article_id -> (version, size, template)
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def version(source):
+        return hashlib.blake2b(source.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get(self, article_id, source):
+        """Returns the compiled template for an article body, compiling it on a miss"""
+        version = self.version(source)
+
+        with self._lock:
+            entry = self._templates.get(article_id)
+            if entry is not None and entry[0] == version:
+                self._templates.move_to_end(article_id)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        # compile outside the lock so a large article does not block readers of other articles
+        template = self.environment.from_string(source)
+        size = len(source)
+
+        with self._lock:
+            self._discard(article_id)
+            if size <= self.max_bytes:
+                self._templates[article_id] = (version, size, template)
+                self._bytes += size
+                while len(self._templates) > self.max_entries or self._bytes > self.max_bytes:
+                    self._discard(next(iter(self._templates)))
+                    self.evictions += 1
+
+        return template
+
+    def invalidate(self, article_id):
+        """Drops the compiled template of an article, call after the article body changed"""
+        with self._lock:
+            self._discard(article_id)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self._bytes = 0
+
+    def _discard(self, article_id):
+        entry = self._templates.pop(article_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._templates),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+            }